@@ -21,6 +21,7 @@ import logging
 import os
 import dfs, utils
 import xmlrpclib
+import threading
 import ring
 from base64 import b32encode, b64encode
 
@@ -28,10 +29,10 @@ logger=logging.getLogger('DHT')
 
 try:
 	from Crypto.Hash import SHA
-	SECURED=False
+	SECURED=True
 except:
 	from sha import sha
-	SECURED=True
+	SECURED=False
 	logger.warn('Not secured')
 
 def get_new_hasher(initial_data=''):
@@ -43,6 +44,8 @@ def get_new_hasher(initial_data=''):
 class MemoryDHT:
 	""" Manages a local DHT in memory """
 	BLOCK_SIZE=1024
+	# the biggest value that the DHT accepts
+	MAX_VALUE_SIZE=16*1024*1024
 	def __init__(self):
 		self.hashtable=dict()
 		logger.info('MemoryDHT ready')
@@ -54,12 +57,27 @@ class MemoryDHT:
 		>>> dht.put('123','data')
 		"""
 		id=b64encode(id)
-		logger.info('Putting %s in %s (key=%s)'%(data,id,key))
+		logger.info('Putting %d bytes in %s (key=%s)'%(len(data),id,key))
 		try:
 			self.hashtable[id][key]=data
 		except KeyError:
 			self.hashtable[id]=dict({key:data})
 
+	def put_many(self,items):
+		""" Puts several values into the hashtable.
+		items is a list of tuples (id,data,key).
+		Returns the number of values that could not be saved
+		
+		>>> dht=MemoryDHT()
+		>>> dht.put_many([('123','data',None),('456','other','nick')])
+		0
+		"""
+		logger.info('Putting %d values'%len(items))
+		for id,data,key in items:
+			if not key: key='default'
+			self.hashtable.setdefault(b64encode(id),dict())[key]=data
+		return 0
+
 	def get(self,id,key='default'):
 		""" Gets a value from the hashtable.
 		
@@ -77,9 +95,43 @@ class MemoryDHT:
 		except KeyError:
 			return None            
 
+	def get_many(self,ids):
+		""" Gets several values from the hashtable.
+		ids is a list of tuples (id,key). Returns a list with the
+		values, or None for the missing ones.
+		
+		>>> dht=MemoryDHT()
+		>>> dht.put_many([('123','data',None),('456','other','nick')])
+		0
+		>>> dht.get_many([('456','nick'),('123',None),('789',None)])
+		['other', 'data', None]
+		"""
+		logger.info('Getting %d values'%len(ids))
+		values=[]
+		for id,key in ids:
+			if not key: key='default'
+			values.append(self.hashtable.get(b64encode(id),{}).get(key))
+		return values
+
+	def has_many(self,ids):
+		""" Checks if there are values for several ids.
+		ids is a list of tuples (id,key). Returns a list of booleans
+		
+		>>> dht=MemoryDHT()
+		>>> dht.put('123','data')
+		>>> dht.has_many([('123',None),('456',None)])
+		[True, False]
+		"""
+		r=[]
+		for id,key in ids:
+			r.append((key or 'default') in self.hashtable.get(b64encode(id),{}))
+		return r
+
 class LocalDHT:
 	""" This class manages a local, persistent DHT """
 	BLOCK_SIZE=1024
+	# the biggest value that the DHT accepts
+	MAX_VALUE_SIZE=16*1024*1024
 	def __init__(self,config=None):
 		""" Creates a persistent DHT. If no 'DHT:datadir' key in
 		config, use default dir './dhtdata' to save the data """
@@ -113,6 +165,16 @@ class LocalDHT:
 			logger.error('Error writing file: '+e.message)
 			return 1
 
+	def put_many(self,items):
+		""" Puts several values into the hashtable.
+		items is a list of tuples (id,data,key).
+		Returns the number of values that could not be saved """
+		logger.debug('Putting %d values'%len(items))
+		errors=0
+		for id,data,key in items:
+			errors+=self.put(id,data,key)
+		return errors
+
 	def get(self,id,key=None):		
 		""" Gets a value from the hashtable.
 		Returns None if no value.
@@ -135,9 +197,35 @@ class LocalDHT:
 			logger.warn('Error reading file: '+e.message)
 			return None
 
+	def get_many(self,ids):
+		""" Gets several values from the hashtable.
+		ids is a list of tuples (id,key). Returns a list with the
+		values, or None for the missing ones. """
+		logger.debug('Getting %d values'%len(ids))
+		values=[]
+		for id,key in ids:
+			if not key: key='default'
+			try:
+				f=open(self.dirpath+os.sep+'%s-%s'%(b32encode(id),key),'r')
+				try:
+					values.append(f.read())
+				finally:
+					f.close()
+			except IOError,e:
+				logger.warn('Error reading file: '+e.message)
+				values.append(None)
+		return values
+
+	def has_many(self,ids):
+		""" Checks if there are values for several ids.
+		ids is a list of tuples (id,key). Returns a list of booleans """
+		return [os.path.exists(self.dirpath+os.sep+'%s-%s'%(b32encode(id),key or 'default')) for id,key in ids]
+
 class OpenDHT:
 	""" An external DHT that connects to OpenDHT """
 	BLOCK_SIZE=1024
+	# OpenDHT does not accept values bigger than 1KB
+	MAX_VALUE_SIZE=1024
 	def __init__(self,gateway="http://opendht.nyuld.net:5851/"):
 		""" Connects to the OpenDHT server. Get a list in http://opendht.org/servers.txt """
 		import xmlrpclib
@@ -149,6 +237,7 @@ class OpenDHT:
 			while res==2:
 				res=self.pxy.put(xmlrpclib.Binary(id),xmlrpclib.Binary(data),600000,'dfs')
 				if res==1: raise OverflowError, 'No capacity'
+			return 0
 		except:
 			return None
 	def get(self,id,key='default'):
@@ -157,23 +246,54 @@ class OpenDHT:
 			return vals[0].data
 		except:
 			return None
+	def put_many(self,items):
+		""" Puts several values. The gateway of OpenDHT does not
+		support batches, so the values are sent one by one """
+		errors=0
+		for id,data,key in items:
+			if self.put(id,data,key)!=0: errors+=1
+		return errors
+	def get_many(self,ids):
+		""" Gets several values, one by one """
+		return [self.get(id,key) for id,key in ids]
+	def has_many(self,ids):
+		""" Checks if there are values for several ids. OpenDHT
+		cannot check a value without getting it """
+		return [self.get(id,key)!=None for id,key in ids]
 
 class NetClientDHT:
 	""" This class manages a DHT in a remote ring as a client. This one
 	if the class that an application of the ring will use """
 	BLOCK_SIZE=1024
+	# values are sent through XML-RPC in base64: keep them small
+	MAX_VALUE_SIZE=4*1024*1024
 	def __init__(self,server='http://localhost:8080'):
 		""" Connects to a node in the ring.
 		server is the address of the node. If None, use 'http://localhost:8080 """
 		logger.info('Using NetServerDHT at '+server)
-		self.ring=xmlrpclib.ServerProxy(server)
+		self.server=server
+		# xmlrpclib proxies cannot be shared between threads: each
+		# thread uses its own connection to the ring
+		self.local=threading.local()
+		# cache of the segments of the ring managed by each node,
+		# shared by the threads
+		self.segments=[]
+		self.segments_lock=threading.Lock()
+
+	def __ring(self):
+		""" Returns the connection to the ring of the current thread """
+		try:
+			return self.local.ring
+		except AttributeError:
+			self.local.ring=xmlrpclib.ServerProxy(self.server)
+			return self.local.ring
 
 	def __hash(self,data):
 		""" Returns a string with a digital integer that represents a 16B hash of the ID """
 		# if data has 16B and it is a number, use the data itself
 		# as identifier (assume that callers know what they are doing)
 		if len(data)!=16:
-			h=get_new_hashser(data).digest()[0:16]
+			h=get_new_hasher(data).digest()[0:16]
 		else:
 			h=data
 		dh=0
@@ -190,7 +310,7 @@ class NetClientDHT:
 		if not key: key='default'
 		logger.debug('Net-putting in %s (key=%s)'%(id,key))
 		h=self.__hash(id)
-		return self.ring.msg(h,'PUT',key,xmlrpclib.Binary(data))
+		return self.__ring().msg(h,'PUT',key,xmlrpclib.Binary(data))
 
 	def get(self,id,key=None):
 		""" Gets a value from the hashtable. """
@@ -198,10 +318,97 @@ class NetClientDHT:
 		logger.debug('Net-getting from %s (key=%s)'%(id,key))
 		h=self.__hash(id)
 		try:
-			return self.ring.msg(h,'GET',key).data
+			return self.__ring().msg(h,'GET',key).data
 		except:
 			return None
 
+	def __segment(self,h):
+		""" Returns the segment (start,end) of the ring managed by the
+		node of the point h. Segments are cached: if the ring changes,
+		nodes answer which values they do not manage any more """
+		self.segments_lock.acquire()
+		try:
+			for s in self.segments:
+				if in_segment(h,s): return s
+		finally:
+			self.segments_lock.release()
+		start,end=self.__ring().msg(h,'SEGMENT')
+		s=(long(start),long(end))
+		self.segments_lock.acquire()
+		try:
+			if not s in self.segments: self.segments.append(s)
+		finally:
+			self.segments_lock.release()
+		return s
+
+	def __many(self,message,requests):
+		""" Sends a batch message with a list of requests [h,...] to the
+		nodes that manage each point h, one message for each node.
+		Returns the list of answers of the nodes, in the same order """
+		answers=[None]*len(requests)
+		pending=range(0,len(requests))
+		while pending:
+			# the node of the first request manages at least that one
+			h=requests[pending[0]][0]
+			s=self.__segment(h)
+			batch=[n for n in pending if in_segment(requests[n][0],s)]
+			pending=[n for n in pending if not in_segment(requests[n][0],s)]
+			logger.debug('Net-sending %s with %d values to the node of %s'%(message,len(batch),h))
+			res=self.__ring().msg(h,message,[requests[n] for n in batch])
+			if type(res)!=list: raise IOError(res)
+			for n,r in zip(batch,res):
+				status=r
+				if type(r)==list: status=r[0]
+				if status==NOT_MANAGED:
+					# the ring changed: forget the segment and try again
+					self.segments_lock.acquire()
+					try:
+						if s in self.segments: self.segments.remove(s)
+					finally:
+						self.segments_lock.release()
+					pending.append(n)
+				else:
+					answers[n]=r
+		return answers
+
+	def put_many(self,items):
+		""" Puts several values into the hashtable, sending one message
+		to each node that manages some of them.
+		items is a list of tuples (id,data,key).
+		Returns the number of values that could not be saved """
+		r=self.__many('PUTMANY',[[self.__hash(id),key or 'default',xmlrpclib.Binary(data)] for id,data,key in items])
+		return len([a for a in r if a])
+
+	def get_many(self,ids):
+		""" Gets several values from the hashtable, sending one message
+		to each node that manages some of them.
+		ids is a list of tuples (id,key). Returns a list with the
+		values, or None for the missing ones. """
+		r=self.__many('GETMANY',[[self.__hash(id),key or 'default'] for id,key in ids])
+		return [a[1].data if a[0]==0 else None for a in r]
+
+	def has_many(self,ids):
+		""" Checks if there are values for several ids, sending one message
+		to each node that manages some of them.
+		ids is a list of tuples (id,key). Returns a list of booleans """
+		r=self.__many('HASMANY',[[self.__hash(id),key or 'default'] for id,key in ids])
+		return [a==0 for a in r]
+
+NOT_MANAGED=2
+""" Status of the answers to batch messages for the ids that the
+node does not manage """
+
+def in_segment(h,segment):
+	""" Returns True if the point h of the ring is in the segment
+	[start,end). If start==end, the segment is the whole ring """
+	h=long(h)
+	start,end=segment
+	if start==end: return True
+	if end>start:
+		return h>=start and h<end
+	else:
+		return h>=start or h<end
+
 class NetServerDHT(ring.RingListener):
 	""" The server of a net DHT. It is set on top of a ring. The ring
 	is intended to be run as a daemon of the system. """
@@ -213,6 +420,7 @@ class NetServerDHT(ring.RingListener):
 		"""
 		if not config: config=ring.config
 		self.localdht=LocalDHT(config)
+		self.ring=ring
 		ring.listener=self
 		if not ring.joined: ring.start()
 		logger.info('NetServerDHT ready')
@@ -223,6 +431,14 @@ class NetServerDHT(ring.RingListener):
 				return self.__get(to,args[1])
 			elif args[0]=='PUT':
 				return self.__put(to,args[1],args[2])
+			elif args[0]=='GETMANY':
+				return self.__getmany(args[1])
+			elif args[0]=='PUTMANY':
+				return self.__putmany(args[1])
+			elif args[0]=='HASMANY':
+				return self.__hasmany(args[1])
+			elif args[0]=='SEGMENT':
+				return [self.ring.id,self.ring.next or self.ring.id]
 			else:
 				return 'No such method: %s'%args[0]
 		except:
@@ -237,3 +453,42 @@ class NetServerDHT(ring.RingListener):
 		except:
 			logger.warn(utils.format_error)
 			return 1
+	def __getmany(self,ids):
+		""" Manages a GETMANY message: ids is a list of [id,key].
+		Returns a list of [status,data], where status is 0 if the value
+		was found, 1 if not and 2 if this node does not manage the id """
+		r=[]
+		for id,key in ids:
+			if not self.ring.manage(id):
+				r.append([NOT_MANAGED,xmlrpclib.Binary('')])
+				continue
+			data=self.localdht.get(id,key)
+			if data==None:
+				r.append([1,xmlrpclib.Binary('')])
+			else:
+				r.append([0,xmlrpclib.Binary(data)])
+		return r
+	def __hasmany(self,ids):
+		""" Manages a HASMANY message: ids is a list of [id,key].
+		Returns a list with 0 if there is a value for the id, 1 if not
+		and 2 if this node does not manage the id """
+		r=[]
+		for id,has in zip(ids,self.localdht.has_many(ids)):
+			if not self.ring.manage(id[0]):
+				r.append(NOT_MANAGED)
+			elif has:
+				r.append(0)
+			else:
+				r.append(1)
+		return r
+	def __putmany(self,items):
+		""" Manages a PUTMANY message: items is a list of [id,key,data].
+		Returns a list with 0 if the value was saved, 1 if there was an
+		error and 2 if this node does not manage the id """
+		r=[]
+		for id,key,data in items:
+			if not self.ring.manage(id):
+				r.append(NOT_MANAGED)
+			else:
+				r.append(self.__put(id,key,data))
+		return r
@@ -38,6 +38,13 @@ advisable """
 dht=None
 """ The DHT to use. You MUST set up this variable before
 using any object of the dfs.filesystem module """
+block_cache=None
+""" A dfs.utils.BlockCache with the blocks read by all the files of
+the process. If None, the blocks are not cached """
+metadata_cache=None
+""" A dfs.utils.BlockCache with the blocks of metadata read recently,
+usually with a ttl. If None, opening a file always reads its metadata
+from the DHT """
 
 def init_default_conf():	
 	""" Sets up a default configuration for DFS: uses $HOME/.dfs as
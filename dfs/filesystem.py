@@ -26,11 +26,21 @@ import dfs
 import logging
 from base64 import b32encode, b32decode
 from types import FileType
+import zlib
+import bisect
+import io
+import hmac
+import hashlib
+import struct
+import threading
+import atexit
 
 logger=logging.getLogger('DFS')
 
 # Name of keys in the configuration directory
 KEY_NAMES=('kd', 'kf', 'ks', 'kss', 'kff', 'kgg')
+# Blocks with a higher entropy (bits per byte) are not compressed
+COMPRESS_ENTROPY=7.0
 
 try:
 	if dfs.NO_SECURITY: raise Error('')
@@ -39,18 +49,32 @@ try:
 	SECURED = True
 except:
 	SECURED = False
-	from sha import sha
 	logger.warn('No crypto module')
-	class DummyEncrypter():
-		def encrypt(self, data): return data
-		def decrypt(self, data): return data
+# used when SECURED is False. It is always defined, so that tests can
+# run the same process with and without security
+class DummyEncrypter():
+	def encrypt(self, data): return data
+	def decrypt(self, data): return data
 
 def get_new_hasher(initial_data=''):
 	""" Gets the configured hasher """
 	if SECURED:
 		return SHA.new(initial_data)
 	else:
-		return sha(initial_data)
+		return hashlib.sha1(initial_data)
+
+def merkle_root(hashes):
+	""" Returns the root of a Merkle tree with a list of hashes as
+	leaves. An odd node is promoted to the next level of the tree """
+	level = list(hashes)
+	if not level: return get_new_hasher().digest()
+	while len(level) > 1:
+		n = []
+		for i in range(0, len(level) - 1, 2):
+			n.append(get_new_hasher(level[i] + level[i + 1]).digest())
+		if len(level) % 2: n.append(level[-1])
+		level = n
+	return level[0]
 
 
 class URI:
@@ -121,7 +145,7 @@ class URI:
 def random_uri(config=None, kd=None):
 	""" Creates a random URI """
 	u = URI('', utils.random_nick(), '', config=config, kd=kd)
-	u.hd=utils.random_string(16, printable=False)
+	u.hd=utils.random_bytes(16)
 	return u
 
 def uri_from_string(uri,config=None,kd=None):
@@ -165,6 +189,254 @@ def uri_from_string(uri,config=None,kd=None):
 		else:
 			return None
 
+class Part(object):
+	""" A reference to a block of a file in the DHT.
+	- hd is the identifier of the block (binary, 16B) and nick the nick
+	of its URI. The URI is only built when it is needed, by get_uri()
+	or get_static()
+	- length is the number of bytes of the file in the block. If None,
+	the whole block is data of the file (maybe with padding if it
+	is the last block)
+	- key is the key of blocks with convergent encryption. If None,
+	the block is encrypted with the key of the file
+	- flags is a string of per-block flags: 'z' for compressed blocks,
+	'b' for blocks encrypted on their own, with an IV derived from the
+	key of the file, the index of the part and the hd of the block, and
+	'a' for authenticated blocks: their hash is a MAC (see block_mac())
+	- iv is the IV of a block rewritten in mode 'r+'. If None, the block
+	goes on with the CBC chain of the previous block
+	- hash is the hash of the block as it is saved in the DHT, to check
+	each block on its own. If None, the block is not checked
+	Files keep many parts in memory, so parts have no __dict__. They
+	are not packed in columns indexed by the number of the part: files
+	load the parts lazily, segment by segment, and change them in
+	place when they are written again. In the old metadata, a part was
+	saved as
+	'dfsf://nick@hd [length] [k=key] [f=flags] [i=iv] [h=hash]' """
+	__slots__ = ('hd', 'nick', 'length', 'key', 'flags', 'iv', 'hash')
+	def __init__(self, hd=None, nick='', length=None, key=None, flags='', iv=None, hash=None):
+		self.hd = hd
+		self.nick = nick
+		self.length = length
+		self.key = key
+		self.flags = flags
+		self.iv = iv
+		self.hash = hash
+	def get_uri(self):
+		""" Returns the URI of the block """
+		u = URI('', self.nick, '')
+		u.hd = self.hd
+		return u
+	def get_static(self):
+		""" Returns the static URI of the block (dfsf://nick@hd) """
+		return 'dfsf://%s@%s'%(self.nick, b32encode(self.hd)[:-6])
+	def __str__(self):
+		s = self.get_static()
+		if self.length is not None: s += ' %d'%self.length
+		if self.key: s += ' k=%s'%b32encode(self.key)
+		if self.flags: s += ' f=%s'%self.flags
+		if self.iv: s += ' i=%s'%b32encode(self.iv)
+		if self.hash: s += ' h=%s'%b32encode(self.hash)
+		return s
+	def check(self, data):
+		""" Returns True if the data of the block matches its hash """
+		return not self.hash or get_new_hasher(data).digest() == self.hash
+	def chained(self):
+		""" Returns True if the block goes on with the CBC chain of the
+		previous block encrypted with the key of the file """
+		return not self.key and not self.iv and not 'b' in self.flags
+
+def part_from_string(part):
+	""" Creates a Part from its description in the metadata
+	
+	>>> p=part_from_string('dfsf://nick@MFRGGZDFMZTWQ2LKNNWG23TPOA 100 k=MFRGGZDFMZTWQ2LKNNWG23TPOA======')
+	>>> print p.nick, p.hd, p.length, p.key
+	nick abcdefghijklmnop 100 abcdefghijklmnop
+	"""
+	v = part.split(' ')
+	m = URI._dfsxexp.match(v[0])
+	p = Part(b32decode(m.group('hd') + '======'), m.group('nick')[:-1])
+	for t in v[1:]:
+		if t.startswith('k='):
+			p.key = b32decode(t[2:])
+		elif t.startswith('f='):
+			p.flags = t[2:]
+		elif t.startswith('i='):
+			p.iv = b32decode(t[2:])
+		elif t.startswith('h='):
+			p.hash = b32decode(t[2:])
+		else:
+			p.length = int(t)
+	return p
+
+def index_from_string(entry):
+	""" Creates an entry (offset, root) of the index of the metadata
+	
+	>>> print index_from_string('1024 MFRGGZDFMZTWQ2LKNNWG23TPOA======')
+	(1024, 'abcdefghijklmnop')
+	"""
+	v = entry.split(' ')
+	root = None
+	if len(v) > 1: root = b32decode(v[1])
+	return (int(v[0]), root)
+
+# Identifier and version of the binary blocks of metadata
+METADATA_MAGIC = 'DFM\x01'
+# Flags of the parts, as bits of their records
+PART_FLAGS = 'zba'
+PART_KEY, PART_IV, PART_HASH = 16, 32, 64
+
+class Metadata:
+	""" A block of metadata of a file: the fields of the file (only in
+	the first block), the references to the parts in Metadata.parts and
+	the entries (offset, root) of the index in Metadata.entries, both by
+	their position in the file. Blocks are saved in a binary format:
+	- METADATA_MAGIC
+	- the number of fields, and the length and value of their name and value
+	- the position of the first part, the number of parts, the bytes of
+	  the longest nick and of the hashes, the optional fields that the
+	  records have, and the records of the parts. The records have a
+	  fixed length: hd, nick, length, flags, key, iv and hash
+	- the position of the first entry, the number of entries, the bytes
+	  of the roots, and the records of the entries: offset, if there is
+	  a root and the root
+	Blocks in the old format of utils.Config are read too.
+	
+	>>> m=Metadata().set('Main:length', 100)
+	>>> m.parts[3]=part_from_string('dfsf://nick@MFRGGZDFMZTWQ2LKNNWG23TPOA 10 f=z h=MFRGGZDFMZTWQ2LKNNWG23TPOBQXEYLZ')
+	>>> m.entries[0]=(0, None)
+	>>> n=Metadata(m.save())
+	>>> print n.getint('Main:length'), n.parts[3], n.entries
+	100 dfsf://nick@MFRGGZDFMZTWQ2LKNNWG23TPOA 10 f=z h=MFRGGZDFMZTWQ2LKNNWG23TPOBQXEYLZ {0: (0, None)}
+	>>> print Metadata('[Main]\\nlength = 5\\n[Part]\\n0 = dfsf://n@MFRGGZDFMZTWQ2LKNNWG23TPOA\\n').parts[0]
+	dfsf://n@MFRGGZDFMZTWQ2LKNNWG23TPOA
+	"""
+	def __init__(self, data=None):
+		self.main = {}
+		self.parts = {}
+		self.entries = {}
+		if data: self.load(data)
+	def get(self, key, default=None):
+		""" Gets a field of the file, as 'Main:name' """
+		return self.main.get(key.split(':')[-1].lower(), default)
+	def getint(self, key, default=0):
+		""" Gets a field of the file as an integer """
+		try:
+			return int(self.get(key, default))
+		except:
+			return default
+	def set(self, key, value):
+		""" Sets a field of the file, as 'Main:name'. Returns the same
+		object, to chain .set() statements """
+		if type(value) in (int, long): value = '%d'%value
+		self.main[key.split(':')[-1].lower()] = str(value or '')
+		return self
+	def save(self):
+		""" Returns the block in the binary format """
+		s = [METADATA_MAGIC, struct.pack('>H', len(self.main))]
+		for k, v in self.main.items():
+			s.append(struct.pack('>B', len(k)) + k + struct.pack('>H', len(v)) + v)
+		# the references to the parts
+		first = min(self.parts.keys() or [0])
+		parts = [self.parts[j] for j in range(first, first + len(self.parts))]
+		nw = max([len(p.nick) for p in parts] or [0])
+		hw = max([len(p.hash or '') for p in parts] or [0])
+		fields = 0
+		for p in parts:
+			if p.key: fields |= PART_KEY
+			if p.iv: fields |= PART_IV
+			if p.hash: fields |= PART_HASH
+		record = struct.Struct(self._part_format(nw, hw, fields))
+		s.append(struct.pack('>IHBBB', first, len(parts), nw, hw, fields))
+		for j in range(0, len(parts)):
+			p = parts[j]
+			flags = 0
+			for f in p.flags: flags |= 1 << PART_FLAGS.index(f)
+			values = [p.hd, p.nick]
+			values.append(p.length is None and 0xFFFFFFFF or p.length)
+			values.append(flags)
+			for bit, v in ((PART_KEY, p.key), (PART_IV, p.iv), (PART_HASH, p.hash)):
+				if v: values[3] |= bit
+				if fields & bit: values.append(v or '')
+			s.append(record.pack(*values))
+		# the entries of the index
+		first = min(self.entries.keys() or [0])
+		entries = [self.entries[j] for j in range(first, first + len(self.entries))]
+		rw = max([len(e[1] or '') for e in entries] or [0])
+		s.append(struct.pack('>IHB', first, len(entries), rw))
+		record = struct.Struct('>QB%ds'%rw)
+		for offset, root in entries:
+			s.append(record.pack(offset, root is not None, root or ''))
+		return ''.join(s)
+	def load(self, data):
+		""" Loads a block, in the binary or in the old format. The data
+		after the block is ignored """
+		if not data.startswith(METADATA_MAGIC):
+			self._load_config(data)
+			return
+		pos = len(METADATA_MAGIC)
+		n = struct.unpack_from('>H', data, pos)[0]
+		pos += 2
+		for i in range(0, n):
+			l = ord(data[pos])
+			k = data[pos + 1:pos + 1 + l]
+			pos += 1 + l
+			l = struct.unpack_from('>H', data, pos)[0]
+			self.main[k] = data[pos + 2:pos + 2 + l]
+			pos += 2 + l
+		first, n, nw, hw, fields = struct.unpack_from('>IHBBB', data, pos)
+		pos += 9
+		record = struct.Struct(self._part_format(nw, hw, fields))
+		for j in range(first, first + n):
+			values = list(record.unpack_from(data, pos))
+			pos += record.size
+			hd, nick, length, flags = values[0:4]
+			p = Part(hd, nick.rstrip('\0'))
+			if not length == 0xFFFFFFFF: p.length = length
+			p.flags = ''.join([PART_FLAGS[b] for b in range(0, len(PART_FLAGS)) if flags & (1 << b)])
+			values = values[4:]
+			for bit, name in ((PART_KEY, 'key'), (PART_IV, 'iv'), (PART_HASH, 'hash')):
+				if not fields & bit: continue
+				v = values.pop(0)
+				if flags & bit: setattr(p, name, v)
+			self.parts[j] = p
+		first, n, rw = struct.unpack_from('>IHB', data, pos)
+		pos += 7
+		record = struct.Struct('>QB%ds'%rw)
+		for j in range(first, first + n):
+			offset, hasroot, root = record.unpack_from(data, pos)
+			pos += record.size
+			if not hasroot: root = None
+			self.entries[j] = (offset, root)
+	def _part_format(self, nw, hw, fields):
+		""" Returns the struct format of the records of the parts """
+		f = '>16s%dsIB'%nw
+		if fields & PART_KEY: f += '16s'
+		if fields & PART_IV: f += '16s'
+		if fields & PART_HASH: f += '%ds'%hw
+		return f
+	def _load_config(self, data):
+		""" Loads a block in the old format of utils.Config """
+		cmd = utils.Config()
+		cmd.load(data)
+		for section in cmd.config.sections():
+			for k, v in cmd.config.items(section, True):
+				if section == 'Main':
+					if not k == 'p': self.main[k] = v
+				elif section == 'Part':
+					self.parts[int(k)] = part_from_string(v)
+				elif section == 'Seg':
+					self.entries[int(k)] = index_from_string(v)
+
+def convergent_uri(key):
+	""" Returns the URI of a block encrypted with a convergent key.
+	The identifier is derived from the key, so the same content
+	always gets the same URI """
+	u = URI('', '', '')
+	u.hd = get_new_hasher(key).digest()[0:16]
+	u.nick = b32encode(u.hd)[0:6]
+	return u
+
 def create_dir(name, uri=None, parent=None, config=None, atomic=True, keys=None):
 	""" Creates a new directory.
 	parent: Optional directory parent of this directory. The directory
@@ -205,7 +477,7 @@ class Dir:
 		self.keys = keys
 		self.uri = uri
 		self.parent = parent
-		f = File(uri,'r', keys, config)
+		f = File(uri, 'r', config=config, keys=keys)
 		self.files = dict()
 		line = ''
 		for l in f.read():
@@ -257,7 +529,7 @@ class Dir:
 		if self.closed: raise IOError('Dir is closed')
 		if not self.modified: return
 		logger.debug('%s dir saves its information'%self.uri.get_readable())
-		f=File(self.uri,'w',self.keys,self.config)
+		f=File(self.uri,'w',config=self.config,keys=self.keys)
 		if self.dirname:
 			f.write('%s:%s%s'%(self.THIS_DIR, self.dirname, self.EOL))
 		for k in self.list():
@@ -272,16 +544,110 @@ class Dir:
 	def __del__(self):
 		self.close()
 
+crypto_pools={}
+""" The pools of processes that encrypt and decrypt the blocks of all
+the files, by their number of workers. See get_crypto_pool() """
+crypto_pools_lock=threading.Lock()
+
+def get_crypto_pool(workers):
+	""" Returns the pool of processes with a number of workers to
+	encrypt and decrypt blocks, creating it the first time """
+	crypto_pools_lock.acquire()
+	try:
+		pool = crypto_pools.get(workers)
+		if not pool:
+			import multiprocessing
+			pool = crypto_pools[workers] = multiprocessing.Pool(workers)
+		return pool
+	finally:
+		crypto_pools_lock.release()
+
+def close_crypto_pools():
+	""" Finishes the processes of the crypto pools. It is called when
+	the program exits """
+	crypto_pools_lock.acquire()
+	try:
+		for pool in crypto_pools.values():
+			pool.close()
+			pool.join()
+		crypto_pools.clear()
+	finally:
+		crypto_pools_lock.release()
+
+atexit.register(close_crypto_pools)
+
+def block_mac(key, hd, data):
+	""" Returns the authentication tag of an encrypted block: a HMAC
+	of its hd and its data. A block cannot be changed or moved to other
+	hd without the key """
+	h = hmac.new(key, hd, hashlib.sha1)
+	h.update(data)
+	return h.digest()
+
+def crypt_block(args):
+	""" Encrypts or decrypts a block in a process of the crypto pool,
+	and hashes the encrypted block. args is a tuple (encrypt, key, iv,
+	data, mac). Returns (data, hash) with the encrypted or decrypted
+	data, or None if key is None and the block is only hashed. If mac
+	is a pair (key, hd), the hash is the tag of block_mac() """
+	encrypt, key, iv, data, mac = args
+	out = None
+	if key and encrypt:
+		out = data = AES.new(key, AES.MODE_CBC, iv).encrypt(data)
+	elif key:
+		out = AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+	if mac: return out, block_mac(mac[0], mac[1], data)
+	return out, get_new_hasher(data).digest()
+
+# Identifiers of the convergent blocks that the files of this process
+# are saving, so that two files with the same content do not send it twice
+uploading_blocks = set()
+uploading_cond = threading.Condition()
+
+def put_blocks(items):
+	""" Saves a list of blocks (id, data, key) in the DHT. Raises IOError
+	if the DHT reports an error """
+	try:
+		errors = dfs.dht.put_many(items)
+	finally:
+		uploading_cond.acquire()
+		try:
+			uploading_blocks.difference_update([item[0] for item in items])
+			uploading_cond.notifyAll()
+		finally:
+			uploading_cond.release()
+	# the blocks of metadata may change in place
+	if dfs.metadata_cache:
+		for item in items: dfs.metadata_cache.remove(item[0])
+	if errors:
+		raise IOError('The DHT cannot save %d blocks'%errors)
+
+def get_metadata(ids):
+	""" Gets a list of blocks of metadata (id, key) from the DHT. Blocks
+	in dfs.metadata_cache are not requested again """
+	cache = dfs.metadata_cache
+	if not cache: return dfs.dht.get_many(ids)
+	data = [cache.get(hd) for hd, nick in ids]
+	missing = [i for i in range(0, len(ids)) if data[i] is None]
+	if missing:
+		got = dfs.dht.get_many([ids[i] for i in missing])
+		for i in range(0, len(missing)):
+			data[missing[i]] = got[i]
+			if got[i]: cache.put(ids[missing[i]][0], got[i])
+	return data
+
 class File():
 	"""
-	Implements a file in the DFS. Note that in the current version, this class is not
-	a complete implementation of a Python file object: the management of lines
-	is not implemented.
+	Implements a file in the DFS. Files follow the protocol of
+	io.RawIOBase, so they can be wrapped in an io.BufferedReader or
+	io.TextIOWrapper, or used by shutil.copyfileobj().
 	"""
 	def __init__(self,uri,mode,config=None,save_metadata=True,keys=None):
 		""" Initializes the file object.
 		- uri is a URI or str object with the address of the file.
-		- mode is the mode of the file. Currently, just 'w' and 'r'
+		- mode is the mode of the file: 'r', 'w', 'a' to append data
+		to an existing file or 'r+' to read and overwrite parts of an
+		existing file
 		- keys are a pair (Kf, Kd) to use. If None, use the pair in the
 		configuration. Kf is used to crypt/decrypt the file and Kd to
 		secure the resource localization
@@ -309,71 +675,97 @@ class File():
 		self.closed = True
 		
 		self.buffer=[]
-		# The maximum block size
+		# The size of the blocks of the file. It is limited by the
+		# biggest value that the DHT accepts, and multiple of 16B (AES)
 		self.BLOCK_SIZE=self.config.getint('File:block',dfs.dht.BLOCK_SIZE)
-		# The file descriptor could be bigger than the block size. To
-		# prevent this, the metadata is chained in several blocks
-		# Use this parameter to control how many part references
-		# a block of metadata holds.
-		self.DESC_PER_METAPART=self.config.getint('File:descPerMetapart',12)
+		if self.BLOCK_SIZE>dfs.dht.MAX_VALUE_SIZE:
+			logger.warn('Block of %d bytes not supported by the DHT'%self.BLOCK_SIZE)
+			self.BLOCK_SIZE=dfs.dht.MAX_VALUE_SIZE
+		self.BLOCK_SIZE=max(16,self.BLOCK_SIZE-self.BLOCK_SIZE%16)
+		# The size of the blocks of metadata. They do not need to be
+		# as big as the blocks of big files
+		self.META_SIZE=min(self.BLOCK_SIZE,self.config.getint('File:metablock',dfs.dht.BLOCK_SIZE))
 		# The max length of the internal buffer before an automatic flush()
-		self.MAX_BUFFER=self.config.getint('File:maxbuffer',4096)
+		self.MAX_BUFFER=max(self.BLOCK_SIZE,self.config.getint('File:maxbuffer',4096))
+		# The max number of flushes being saved in the DHT at the same
+		# time by a pool of threads. If 0, parts are saved inmediately
+		self.MAX_UPLOADS=self.config.getint('File:uploads',0)
+		self.uploader=None
+		self.uploading=[]
+		self.upload_errors=[]
+		# If File:chunking is 'cdc', the file is split in chunks of
+		# variable length in content defined boundaries. An insertion in
+		# the file then only changes the parts around it
+		if self.config.get('File:chunking','fixed')=='cdc':
+			maxsize=self.config.getint('File:chunkmax',self.BLOCK_SIZE)
+			self.chunker=utils.Chunker(self.config.getint('File:chunkmin',maxsize/8),
+				self.config.getint('File:chunkavg',maxsize/2), maxsize)
+			self.MAX_BUFFER=max(self.MAX_BUFFER,2*maxsize)
+		else:
+			self.chunker=None
+		# If File:dedup is set, each block is encrypted with a key
+		# derived from its content and the key of the user, and saved
+		# with an identifier derived from that key. Blocks already in
+		# the DHT are not sent again
+		self.DEDUP=self.config.getbool('File:dedup',False)
+		# Convergent blocks that other files of this process were saving
+		# when this file found them. They are checked in close()
+		self.deferred=[]
+		# If File:compress is a zlib level (1-9), blocks are compressed
+		# before encryption, unless they look random
+		self.COMPRESS=self.config.getint('File:compress',0)
+		# If File:crypto is 'block', each block is encrypted on its own
+		# and can be decrypted in any order. If 'chain', the blocks
+		# are a single CBC chain, as in old versions
+		self.CRYPTO=self.config.get('File:crypto','block')
+		# If File:cryptoworkers is set, blocks encrypted on their own are
+		# encrypted and decrypted by a pool of processes, using all the
+		# cores. The blocks are copied to the processes
+		self.CRYPTO_WORKERS=self.config.getint('File:cryptoworkers',0)
+		# If File:aead is set, blocks encrypted with the key of the file
+		# are authenticated with a MAC instead of a plain hash. This is
+		# encrypt-then-MAC: the MAC is a second pass over the encrypted
+		# block. Files with only authenticated parts have no Main:hash
+		self.AEAD=self.config.getbool('File:aead',False)
+		self.dedup_hits=0
+		self.dedup_bytes=0
+		# Times a block that is missing or does not match its hash is
+		# requested again to the DHT
+		self.RETRIES=self.config.getint('File:retries',2)
 		self.save_metadata=save_metadata
+		# Index of the first part whose reference changed. Blocks of
+		# metadata with references to previous parts are not saved again
+		self.dirty=0
+		if mode=='a': self.dirty=None
+		# Indexes of other parts whose reference changed
+		self.touched=set()
+		# Index of the blocks of metadata of an existing file. See
+		# _read_metadata() and _save_index()
+		self.index=None
+		# Number of entries in each node of the index
+		self.FANOUT=self.config.getint('File:fanout',max(2,self.META_SIZE/64))
+		# The file descriptor could be bigger than the block size. To
+		# prevent this, the metadata is split in several blocks. The
+		# first one holds DESC_FIRST part references, and the others
+		# DESC_PER_METAPART. By default, as many as fit in META_SIZE
+		self._set_capacity()
 		
 		if mode=='r':
-			# crypter used to decrypt the metadata. There is always
-			# a crypter to protect against casual atackers, but
-			# if there is no Kff the crypter is nearly useless
-			if SECURED:
-				if self.keys and self.keys[0]:
-					mdencrypter=AES.new(self.keys[4],AES.MODE_CBC,self.uri.get_hd())
-				else:
-					mdencrypter=AES.new(self.uri.get_hd(),AES.MODE_CBC,self.uri.get_hd())
-			else:
-				mdencrypter=DummyEncrypter()
-			# get the metadata from the DHT
-			md=dfs.dht.get(uri.get_hd(),uri.nick)
-			if not md: raise IOError('No reference to that file: ' + uri.get_static())
-			self.metadata=utils.Config()
-			md=mdencrypter.decrypt(md)
-			try:
-				self.metadata.load(md)
-			except:
-				raise IOError('The reference is not metatada: %s'%utils.format_error())
-			# get basic information from the metadata
-			self.uri.uid=self.metadata.get('Main:UID')
-			self.uri.nick=self.metadata.get('Main:nick')
-			np=self.metadata.getint('Main:parts', 0)
-			self.filelength=self.metadata.getint('Main:length')
-			# get info about each one of the parts
-			self.parts=[]
-			cmd=self.metadata
-			for next_part in range(0,np):
-				self.parts.append(cmd.get("Part:%d"%next_part))
-				# load chained metadata
-				if next_part<np-1 and next_part%self.DESC_PER_METAPART==self.DESC_PER_METAPART-1:
-					nuri=uri_from_string(cmd.get('Main:n'))
-					md=dfs.dht.get(nuri.get_hd(),nuri.nick)
-					if not md: raise IOError('No reference to %s (%d)'%(nuri.get_static(),next_part))
-					md=mdencrypter.decrypt(md)
-					cmd=utils.Config()
-					try:
-						cmd.load(md)
-					except:
-						raise IOError('The reference is not metadata: %s'%utils.format_error())
-					
+			self._read_metadata()
 			self.eof=bool(len(self.parts)==0)
 		elif mode=='w':
 			if not self.uri.uid: self.uri.uid=dfs.default_config.get('Main:UID')
 			if not self.uri.nick:
 				self.uri.nick=dfs.default_config.get('Main:nick')
 				#if not self.uri.nick: self.uri.nick=utils.random_nick()
-			self.metadata=utils.Config()
-			self.metadata.set('Main:UID',self.uri.uid)
-			if self.uri.nick:
-				self.metadata.set('Main:nick',self.uri.nick)
+			self._new_metadata()
 			self.parts=[]
 			self.filelength=0
+			# the write buffer is a contiguous array of bytes: blocks
+			# are carved from it in flush() without per-byte objects
+			self.buffer=bytearray()
+		elif mode in ('a', 'r+'):
+			self._read_metadata()
 		else:
 			raise IOError,'Mode not supported: %s'%mode
 		
@@ -385,13 +777,16 @@ class File():
 				s+='0'
 		logger.info(s)
 		
-		# Create hasher and crypter
-		self.hasher=get_new_hasher()
+		# Create crypter and hasher
 		if self.keys[1] and SECURED:
 			# The crypter is AES in CBC mode, with IV=Hd of the file
 			self.crypter=AES.new(self.keys[1],AES.MODE_CBC,self.uri.get_hd())
 		else:
 			self.crypter=None
+		self.hasher=self._file_hasher()
+		if mode=='a': self._prepare_append()
+		if mode in ('r', 'r+'): self._prepare_random_access()
+		if mode=='r+': self._prepare_update()
 		
 		logger.info('Opening %s in mode=%s'%(self.uri.get_readable(),self.mode))
 		self.closed = False
@@ -402,141 +797,1177 @@ class File():
 		You can always access to the metadata with File.metadata """
 		if self.closed: return
 		logger.info('Closing %s'%self.uri.get_readable())
-		if self.mode == 'w':
-			self.flush(True)
+		if self.mode in ('w', 'a', 'r+'):
+			if not self.upload_errors: self.flush(True)
+			self._finish_uploads()
+			if self.DEDUP:
+				logger.info('%d parts already in the DHT (%d bytes not sent)'%(self.dedup_hits, self.dedup_bytes))
 			self.metadata.set('Main:parts', len(self.parts))
 			self.metadata.set('Main:length', self.filelength)
-			self.metadata.set('Main:hash', self.hasher.hexdigest())
-			self.metadata.set('Main:p', '')
+			self.metadata.set('Main:block', self.BLOCK_SIZE)
+			if self.hasher: self.metadata.set('Main:hash', self.hasher.hexdigest())
+			blocks=self._metadata_blocks()
+			if [m for u,m in blocks if len(m.save())>self.META_SIZE]:
+				# a writer with other settings added fields to the records
+				# of the parts: save all the blocks again, with room for
+				# the biggest records
+				logger.info('Saving again the metadata of %s'%self.uri.get_readable())
+				self._load_parts(0,len(self.parts)-1)
+				self._set_capacity(True)
+				self.dirty=0
+				blocks=self._metadata_blocks()
 			if self.save_metadata:
-				# variables used to chain metadata blocks
-				puri = self.uri
-				pmeta = self.metadata
-				not_saved = True
-				# crypter used to encrypt the metadata. There is always
-				# a crypter to protect against casual atackers, but
-				# if there is no Kf the crypter is nearly useless
-				if SECURED:
-					if self.keys[4]:
-						mdencrypter = AES.new(self.keys[4], AES.MODE_CBC, self.uri.get_hd())
-					else:
-						mdencrypter = AES.new(self.uri.get_hd(), AES.MODE_CBC, self.uri.get_hd())
-				else:
-					mdencrypter = DummyEncrypter()
-				for i in range(0, len(self.parts)):
-					pmeta.set('Part:%d'%i, self.parts[i])
-					# chain the metadata blocks, each block only with
-					# DESC_PER_METAPART references to parts of the file
-					if i<len(self.parts)-1 and i%self.DESC_PER_METAPART == self.DESC_PER_METAPART-1:
-						nuri=URI(self.uri.uid,utils.random_nick(),'',self.keys)
-						nuri.hd=utils.random_string(16,False)
-						pmeta.set('Main:n',nuri.get_static())
-						m=pmeta.save()
-						pmeta.set('Main:p',utils.random_string(self.BLOCK_SIZE-len(m)))
-						m=mdencrypter.encrypt(pmeta.save())
-						dfs.dht.put(puri.get_hd(),m,puri.nick)
-						pmeta=utils.Config()
-						pmeta.set('Main:p','')
-						puri=nuri
-						not_saved=False
-					else:
-						not_saved=True
-				if not_saved:
-					m=pmeta.save()
-					pmeta.set('Main:p',utils.random_string(self.BLOCK_SIZE-len(m)))
-					m=mdencrypter.encrypt(pmeta.save())
-					dfs.dht.put(puri.get_hd(),m,puri.nick)
-
-			# Create the final metadata
+				put_blocks([self._metadata_block(u,m) for u,m in blocks])
+
+			# Create the final metadata, with the loaded parts
 			for i in range(0,len(self.parts)):
-				self.metadata.set('Part:%d'%i,self.parts[i])
+				if self.parts[i]: self.metadata.parts[i]=self.parts[i]
 		else:
-			# In read, free the buffer
+			# In read, free the buffer and stop the requests in advance
 			self.buffer = None
+			self._cancel_read_ahead()
+			if self.prefetcher:
+				self.prefetcher.close()
+				self.prefetcher = None
 		self.closed = True
 		return self.uri
+	def _metadata_blocks(self):
+		""" Sets the fields of the layout of the metadata, and returns
+		the blocks of metadata that changed as pairs (uri, Metadata). The
+		first one is File.metadata """
+		# the references to the parts are saved in a first block of
+		# DESC_FIRST references and blocks of DESC_PER_METAPART
+		# references. The identifiers of the blocks after the first one
+		# are derived from Hd, so readers can get any of them directly
+		self.metadata.parts={}
+		self.metadata.entries={}
+		nsegments=self._segment_of(max(0,len(self.parts)-1))+1
+		self.metadata.set('Main:segments', nsegments)
+		self.metadata.set('Main:dpm', self.DESC_PER_METAPART)
+		touched=set([self._segment_of(j) for j in self.touched])
+		saved=[i for i in range(0,nsegments) if i==0 or self._segment_start(i+1)>self.dirty or i in touched]
+		for i in saved:
+			self._load_parts(self._segment_start(i),min(len(self.parts),self._segment_start(i+1))-1)
+		nodes=self._save_index(nsegments,set(saved))
+		blocks=[]
+		for i in saved:
+			if i==0:
+				puri=self.uri
+				pmeta=self.metadata
+			else:
+				puri=self._segment_uri(i)
+				pmeta=Metadata()
+			for j in range(self._segment_start(i),min(len(self.parts),self._segment_start(i+1))):
+				pmeta.parts[j]=self.parts[j]
+			blocks.append((puri,pmeta))
+		return blocks+nodes
+	def _read_metadata(self):
+		""" Reads the metadata of an existing file: sets File.metadata,
+		File.parts, File.offsets and File.filelength. Only the first
+		block of metadata is read: the references to the parts in other
+		blocks are None until _load_parts() reads them """
+		mdencrypter=self._metadata_crypter(self.uri.get_hd())
+		# get the metadata from the DHT
+		md=get_metadata([(self.uri.get_hd(),self.uri.nick)])[0]
+		if not md: raise IOError('No reference to that file: ' + self.uri.get_static())
+		self.metadata=self._load_metadata(md,mdencrypter)
+		# get basic information from the metadata
+		self.uri.uid=self.metadata.get('Main:UID')
+		self.uri.nick=self.metadata.get('Main:nick')
+		np=self.metadata.getint('Main:parts', 0)
+		self.stored_parts=np
+		self.filelength=self.metadata.getint('Main:length')
+		self.file_block=self.metadata.getint('Main:block',self.BLOCK_SIZE)
+		nsegments=self.metadata.getint('Main:segments',0)
+		if self.metadata.entries:
+			# File.index[l] are the entries (offset, root) of the level l
+			# of the index, or None if they are not loaded yet. The
+			# entries of the top level are in this block
+			levels=self.metadata.getint('Main:levels',0)
+			self.FANOUT=self.metadata.getint('Main:fanout',self.FANOUT)
+			self._set_capacity()
+			self.index=[]
+			n=nsegments
+			for l in range(0,levels+1):
+				self.index.append([None]*n)
+				n=(n+self.FANOUT-1)/self.FANOUT
+			top=self.index[levels]
+			for i in range(0,len(top)):
+				top[i]=self.metadata.entries.get(i,(0,None))
+			roots=[e[1] for e in top]
+			root=self.metadata.get('Main:merkle')
+			if root and (None in roots or not root==merkle_root(roots).encode('hex')):
+				raise IOError('The references to the parts of %s are corrupt'%self.uri.get_static())
+			# use the number of references per block of the writer. The
+			# blocks of old files have the same number as the first one
+			n=0
+			while n<np and n in self.metadata.parts: n+=1
+			if nsegments>1 or n>self.DESC_FIRST: self.DESC_FIRST=n
+			if nsegments>1: self.DESC_PER_METAPART=self.metadata.getint('Main:dpm',n)
+			self.parts=[None]*np
+			self.offsets=[0]*(np+1)
+			self.loaded=set()
+			for i in range(0,len(top)): self._set_offsets(levels,i)
+			self.offsets[np]=self.filelength
+			self._add_parts(0,self.metadata)
+			return
+		# old files: load all the blocks of metadata
+		segments=[self.metadata]
+		if nsegments>1:
+			# their identifiers are derived from Hd: get all of them at once
+			uris=[self._segment_uri(i) for i in range(1,nsegments)]
+			mds=get_metadata([(u.get_hd(),u.nick) for u in uris])
+			for i in range(0,len(uris)):
+				if not mds[i]: raise IOError('No reference to %s (%d)'%(uris[i].get_static(),i+1))
+				segments.append(self._load_metadata(mds[i],self._metadata_crypter(uris[i].get_hd())))
+		else:
+			# old files: follow the chain of blocks
+			while segments[-1].get('Main:n'):
+				nuri=uri_from_string(segments[-1].get('Main:n'))
+				md=get_metadata([(nuri.get_hd(),nuri.nick)])[0]
+				if not md: raise IOError('No reference to %s (%d)'%(nuri.get_static(),len(segments)))
+				segments.append(self._load_metadata(md,mdencrypter))
+		# get info about each one of the parts
+		self.parts=[]
+		for cmd in segments:
+			p=cmd.parts.get(len(self.parts))
+			while p and len(self.parts)<np:
+				self.parts.append(p)
+				p=cmd.parts.get(len(self.parts))
+			# use the number of references per block of the writer
+			if cmd is self.metadata and len(segments)>1:
+				self.DESC_FIRST=self.DESC_PER_METAPART=len(self.parts)
+		if len(self.parts)<np: raise IOError('Incomplete metadata: %d parts of %d'%(len(self.parts),np))
+		root=self.metadata.get('Main:merkle')
+		if root and not root==merkle_root([p.hash for p in self.parts]).encode('hex'):
+			raise IOError('The references to the parts of %s are corrupt'%self.uri.get_static())
+		self.offsets=[0]
+		for p in self.parts:
+			if p.length is None:
+				self.offsets.append(self.offsets[-1]+self.file_block)
+			else:
+				self.offsets.append(self.offsets[-1]+p.length)
+		self.offsets[-1]=self.filelength
+		# old files are saved again with the new layout
+		if not nsegments: self.dirty=0
+	def _add_parts(self, i, cmd):
+		""" Adds the references to the parts in the i-th block of metadata """
+		first=self._segment_start(i)
+		parts=[]
+		for j in range(first,min(self.stored_parts,self._segment_start(i+1))):
+			p=cmd.parts.get(j)
+			if not p: raise IOError('Incomplete metadata: no part %d'%j)
+			parts.append(p)
+		root=None
+		# the root of the first block may be unknown: the block is
+		# protected by the index inside it
+		if self.index[0][i]: root=self.index[0][i][1]
+		if root and not root==merkle_root([p.hash for p in parts]):
+			raise IOError('The references to the parts of %s are corrupt'%self.uri.get_static())
+		for j in range(first,first+len(parts)):
+			p=parts[j-first]
+			if hasattr(self,'original') and self.original[j] is None: self.original[j]=p
+			# parts that changed, or were removed, are not loaded
+			if j>=len(self.parts) or not self.parts[j] is None: continue
+			self.parts[j]=p
+			if j+1<len(self.offsets)-1:
+				if p.length is None:
+					self.offsets[j+1]=self.offsets[j]+self.file_block
+				else:
+					self.offsets[j+1]=self.offsets[j]+p.length
+		self.loaded.add(i)
+	def _load_parts(self, first, last):
+		""" Loads the references to the parts first..last. The blocks of
+		metadata with them are requested at once """
+		if not self.index: return
+		wanted=[i for i in range(self._segment_of(first),self._segment_of(last)+1) if i<len(self.index[0]) and not i in self.loaded]
+		if not wanted: return
+		self._load_index(0,wanted)
+		uris=[self._segment_uri(i) for i in wanted]
+		mds=get_metadata([(u.get_hd(),u.nick) for u in uris])
+		for i in range(0,len(wanted)):
+			if not mds[i]: raise IOError('No reference to %s (%d)'%(uris[i].get_static(),wanted[i]))
+			self._add_parts(wanted[i],self._load_metadata(mds[i],self._metadata_crypter(uris[i].get_hd())))
+	def _load_index(self, l, entries):
+		""" Loads a list of entries of the level l of the index. The
+		nodes with them are requested at once, after their parents """
+		missing=[j for j in entries if self.index[l][j] is None]
+		if not missing: return
+		nodes=sorted(set([j/self.FANOUT for j in missing]))
+		self._load_index(l+1,nodes)
+		uris=[self._index_uri(l+1,n) for n in nodes]
+		mds=get_metadata([(u.get_hd(),u.nick) for u in uris])
+		for k in range(0,len(nodes)):
+			if not mds[k]: raise IOError('No reference to %s (%d.%d)'%(uris[k].get_static(),l+1,nodes[k]))
+			cmd=self._load_metadata(mds[k],self._metadata_crypter(uris[k].get_hd()))
+			children=range(nodes[k]*self.FANOUT,min(len(self.index[l]),(nodes[k]+1)*self.FANOUT))
+			found=[]
+			for c in children:
+				e=cmd.entries.get(c)
+				if not e: raise IOError('Incomplete index: no entry %d.%d'%(l,c))
+				found.append(e)
+			root=self.index[l+1][nodes[k]][1]
+			roots=[e[1] for e in found]
+			if root and (None in roots or not root==merkle_root(roots)):
+				raise IOError('The index of %s is corrupt'%self.uri.get_static())
+			for c in children:
+				if self.index[l][c] is None:
+					self.index[l][c]=found[c-children[0]]
+					self._set_offsets(l,c)
+	def _index_entry(self, l, i):
+		""" Returns the i-th entry of the level l of the index """
+		if self.index[l][i] is None: self._load_index(l,[i])
+		return self.index[l][i]
+	def _set_offsets(self, l, i):
+		""" The offset of parts not loaded yet is the offset of the
+		deepest entry of the index that is loaded above them. The offsets
+		are not exact, but they are sorted """
+		span=self.FANOUT**l
+		offset=self.index[l][i][0]
+		for j in range(self._segment_start(i*span),min(len(self.parts),self._segment_start((i+1)*span))):
+			if self.parts[j] is None: self.offsets[j]=offset
+	def _find_segment(self, pos):
+		""" Returns the index of the block of metadata with the part that
+		has the byte pos, walking the index from the top """
+		l=len(self.index)-1
+		entries=range(0,len(self.index[l]))
+		while True:
+			j=entries[0]
+			for c in entries:
+				if self.index[l][c][0]<=pos: j=c
+			if l==0: return j
+			l-=1
+			entries=range(j*self.FANOUT,min(len(self.index[l]),(j+1)*self.FANOUT))
+			self._load_index(l,entries)
+	def _save_index(self, nsegments, saved):
+		""" Sets the index of the blocks of metadata in the first block,
+		and returns the nodes of the index to save as pairs (uri, Config).
+		The entries of the index are the offset in the file of the first
+		part under them and the root of a tree with the hashes of the
+		parts (or the roots of the entries) under them. Each node has up
+		to FANOUT entries. Only the nodes over the blocks in saved change """
+		# entries of the blocks of metadata, None if they did not change
+		level=[]
+		offset=0
+		for i in range(0,nsegments):
+			if not i in saved and self.index:
+				level.append(None)
+				offset=None
+				continue
+			if offset is None:
+				if i<len(self.index[0]):
+					offset=self._index_entry(0,i)[0]
+				else:
+					offset=self._index_entry(0,i-1)[0]
+					for p in self.parts[self._segment_start(i-1):self._segment_start(i)]:
+						if p.length is None:
+							offset+=self.BLOCK_SIZE
+						else:
+							offset+=p.length
+			parts=self.parts[self._segment_start(i):self._segment_start(i+1)]
+			root=None
+			if not [p for p in parts if not p.hash]: root=merkle_root([p.hash for p in parts])
+			level.append((offset,root))
+			for p in parts:
+				if p.length is None:
+					offset+=self.BLOCK_SIZE
+				else:
+					offset+=p.length
+		nodes=[]
+		l=0
+		while len(level)>self.FANOUT:
+			upper=[]
+			for j in range(0,(len(level)+self.FANOUT-1)/self.FANOUT):
+				children=range(j*self.FANOUT,min(len(level),(j+1)*self.FANOUT))
+				if self.index and l+1<len(self.index) and j<len(self.index[l+1]) and \
+					len(level)==len(self.index[l]) and not [c for c in children if level[c]]:
+					# the node is already in the DHT
+					upper.append(None)
+					continue
+				node=Metadata()
+				roots=[]
+				for c in children:
+					e=level[c] or self._index_entry(l,c)
+					node.entries[c]=e
+					roots.append(e[1])
+				root=None
+				if not None in roots: root=merkle_root(roots)
+				upper.append(((level[children[0]] or self._index_entry(l,children[0]))[0],root))
+				nodes.append((self._index_uri(l+1,j),node))
+			level=upper
+			l+=1
+		roots=[]
+		for c in range(0,len(level)):
+			e=level[c] or self._index_entry(l,c)
+			self.metadata.entries[c]=e
+			roots.append(e[1])
+		self.metadata.set('Main:levels',l)
+		self.metadata.set('Main:fanout',self.FANOUT)
+		if not None in roots:
+			self.metadata.set('Main:merkle',merkle_root(roots).encode('hex'))
+		return nodes
+	def _metadata_block(self, uri, cmd):
+		""" Pads and encrypts a block of metadata. Returns the tuple
+		(hd, data, nick) to save it in the DHT. Raises IOError if the
+		block is bigger than META_SIZE """
+		m=cmd.save()
+		if len(m)>self.META_SIZE:
+			raise IOError('The block of metadata %s needs %d bytes, more than %d'%(uri.get_static(),len(m),self.META_SIZE))
+		m+=utils.random_bytes(self.META_SIZE-len(m))
+		m=self._metadata_crypter(uri.get_hd()).encrypt(m)
+		return (uri.get_hd(),m,uri.nick)
+	def _set_capacity(self, biggest=False):
+		""" Sets DESC_FIRST and DESC_PER_METAPART, the number of part
+		references in the first block of metadata and in the others, from
+		File:descPerMetapart or from the biggest records this file may
+		write. If biggest, from the biggest records of any writer. The
+		first block also has the fields of the file and the top of the
+		index """
+		n=self.config.getint('File:descPerMetapart',0)
+		if n and not biggest:
+			self.DESC_FIRST=self.DESC_PER_METAPART=n
+			return
+		part=Part('\0'*16,'n'*len(utils.random_nick()),0,flags=PART_FLAGS,hash='\0'*20)
+		if self.DEDUP or biggest: part.key='\0'*16
+		if self.CRYPTO=='chain' or biggest: part.iv='\0'*16
+		empty=len(Metadata().save())
+		m=Metadata()
+		m.parts[0]=part
+		record=len(m.save())-empty
+		self.DESC_PER_METAPART=max(1,(self.META_SIZE-empty)/record)
+		m=Metadata()
+		# the biggest values of the fields
+		for k, n in (('parts',10),('length',20),('block',10),('hash',40),('merkle',40),
+			('segments',10),('dpm',10),('levels',10),('fanout',10)):
+			m.set('Main:'+k,'0'*n)
+		m.set('Main:UID',self.uri.uid or dfs.default_config.get('Main:UID',''))
+		m.set('Main:nick',self.uri.nick or dfs.default_config.get('Main:nick',''))
+		for c in range(0,self.FANOUT): m.entries[c]=(0,'\0'*20)
+		self.DESC_FIRST=max(1,(self.META_SIZE-len(m.save()))/record)
+	def _segment_of(self, j):
+		""" Returns the index of the block of metadata with the j-th part """
+		if j<self.DESC_FIRST: return 0
+		return 1+(j-self.DESC_FIRST)/self.DESC_PER_METAPART
+	def _segment_start(self, i):
+		""" Returns the index of the first part in the i-th block of metadata """
+		if i==0: return 0
+		return self.DESC_FIRST+(i-1)*self.DESC_PER_METAPART
+	def _part(self, i):
+		""" Returns the i-th part, loading its reference if needed """
+		if self.parts[i] is None: self._load_parts(i,i)
+		return self.parts[i]
+	def _chain_prev(self, i):
+		""" Returns the index of the part before the i-th one in the
+		CBC chain of the file as it is saved in the DHT, or -1 """
+		k=i-1
+		while k>=0:
+			if self.original[k] is None: self._load_parts(k,k)
+			if not self.original[k].key: break
+			k-=1
+		return k
+	def _prepare_append(self):
+		""" Prepares an existing file to append data. If the last part
+		is not complete, it is removed and its data written again with
+		the new data, so an append only costs the new bytes """
+		# the hash of the file chains the hash of the previous version
+		# with the new parts
+		self.hasher=self._file_hasher(self.metadata.get('Main:hash',''))
+		# keep the block size of the file: it is the size of its old parts
+		block=self.file_block
+		self.BLOCK_SIZE=block
+		self.MAX_BUFFER=max(self.MAX_BUFFER,block)
+		self.original=list(self.parts)
+		last=None
+		if self.parts and (self._part(len(self.parts)-1).length is not None or self.filelength%block):
+			last=self.parts.pop()
+		if self.dirty is None: self.dirty=len(self.parts)
+		# the crypter goes on from the last part encrypted with it
+		prev=self._chain_prev(len(self.parts))
+		if prev>=0: self._part(prev)
+		chain=self.crypter and prev>=0 and (self.CRYPTO=='chain' or (last and last.chained()))
+		wanted=[]
+		if chain: wanted.append(self.parts[prev])
+		if last: wanted.append(last)
+		data=self._get_parts(wanted)
+		iv=self.uri.get_hd()
+		if chain: iv=data[0][-16:]
+		self.buffer=bytearray()
+		if last:
+			if self.crypter: self.crypter=AES.new(self.keys[1],AES.MODE_CBC,iv)
+			d=self._decode_part(last,data[-1],len(self.parts))
+			self.buffer+=d[:self.filelength-self.offsets[len(self.parts)]]
+		if self.crypter: self.crypter=AES.new(self.keys[1],AES.MODE_CBC,iv)
+		# the metadata is written again in close()
+		self._new_metadata()
+	def _prepare_random_access(self):
+		""" Prepares an existing file to be read from any position.
+		The parts are loaded when they are needed """
+		self.BLOCK_SIZE=self.file_block
+		# the parts as they are in the DHT
+		self.original=list(self.parts)
+		# modified parts not saved yet, cache of encrypted parts and
+		# parts decrypted by the crypto pool
+		self.pending={}
+		self.ciphertexts={}
+		self.decrypted={}
+		self.pos=0
+		# the last decoded parts, as tuples (index, ref, data)
+		self.WINDOW=self.config.getint('File:window',2)
+		self.window=[]
+		# In sequential reads, up to File:readahead parts after the
+		# current one are requested in the background. The number of
+		# parts grows while the reader has to wait for them, and goes
+		# back to one part after a read that does not follow the last one
+		self.READAHEAD=self.config.getint('File:readahead',4)
+		self.ahead=1
+		self.prefetcher=None
+		self.prefetched={}
+		self.next_pos=0
+	def _prepare_update(self):
+		""" Prepares an existing file to be read and overwritten. Only
+		the parts that change are saved again """
+		self.hasher=self._file_hasher(self.metadata.get('Main:hash',''))
+		# new parts have the block size of the file
+		self.MAX_BUFFER=max(self.MAX_BUFFER,self.BLOCK_SIZE)
+		self.chunker=None
+		self.dirty=len(self.parts)
+		# new data goes to the last part
+		if self.parts: self._part(len(self.parts)-1)
+		self._new_metadata()
+	def _file_hasher(self, previous=''):
+		""" Returns the hasher of the whole file, chained with the hash
+		of its previous version. Returns None if the file has no hash and
+		all its new parts are authenticated: the Merkle root of their
+		tags already covers the file """
+		if not previous and self.AEAD and self.crypter and not self.DEDUP: return None
+		return get_new_hasher(previous)
+	def _new_metadata(self):
+		""" Creates the metadata of a file to be saved """
+		self.metadata=Metadata()
+		self.metadata.set('Main:UID',self.uri.uid)
+		if self.uri.nick:
+			self.metadata.set('Main:nick',self.uri.nick)
+	def _get_parts(self, parts, keys=None):
+		""" Gets the data of a list of parts from the DHT, without decoding it.
+		Each block is checked with its hash as soon as it arrives, and
+		only the missing or corrupt blocks are requested again. If keys
+		is a list with the (key, IV) of each part or None, the crypto
+		pool decrypts the blocks while it checks them, and the pair
+		(data, plain) is returned. plain has the decrypted blocks, or None
+		for the blocks that were not decrypted """
+		data = [None] * len(parts)
+		plain = [None] * len(parts)
+		wanted = range(0, len(parts))
+		cache = dfs.block_cache
+		if cache and not cache.plaintext:
+			for i in wanted:
+				data[i] = cache.get(parts[i].hd)
+			wanted = [i for i in wanted if data[i] is None]
+		for attempt in range(0, self.RETRIES + 1):
+			if not wanted: break
+			if attempt: logger.warn('Requesting %d parts again'%len(wanted))
+			got = dfs.dht.get_many([(parts[i].hd, parts[i].nick) for i in wanted])
+			checked = self._check_parts([parts[i] for i in wanted], got, keys and [keys[i] for i in wanted])
+			failed = []
+			for n in range(0, len(wanted)):
+				i = wanted[n]
+				if checked[n] is False:
+					failed.append(i)
+					continue
+				data[i] = got[n]
+				if not checked[n] is True: plain[i] = checked[n]
+				if cache and not cache.plaintext: cache.put(parts[i].hd, got[n])
+			wanted = failed
+		if wanted: raise IOError('Missing or corrupt part %s'%parts[wanted[0]].get_static())
+		if keys is None: return data
+		return data, plain
+	def _check_parts(self, parts, data, keys=None):
+		""" Checks a list of blocks from the DHT with their parts. Returns
+		a list with False for the missing or corrupt blocks, and True for
+		the others, or their decrypted data if keys has their (key, IV).
+		The crypto pool checks and decrypts the blocks at once, if there
+		is one """
+		found = [n for n in range(0, len(parts)) if data[n] is not None]
+		items = []
+		for n in found:
+			key, iv = keys and keys[n] or (None, None)
+			mac = self._mac(parts[n])
+			if 'a' in parts[n].flags and not mac: raise IOError('No key to authenticate %s'%parts[n].get_static())
+			items.append((False, key, iv, data[n], mac))
+		done = self._crypt_pool(items)
+		if done is None:
+			return [data[n] is not None and self._check_part(parts[n], data[n]) for n in range(0, len(parts))]
+		checked = [False] * len(parts)
+		for n, (d, h) in zip(found, done):
+			if parts[n].hash and not hmac.compare_digest(h, parts[n].hash): continue
+			checked[n] = True
+			if d is not None: checked[n] = d
+		return checked
+	def _metadata_crypter(self, iv):
+		""" Returns the crypter of a block of metadata. There is always
+		a crypter to protect against casual atackers, but if there is no
+		Kff the crypter is nearly useless """
+		if not SECURED: return DummyEncrypter()
+		if self.keys[4]: return AES.new(self.keys[4], AES.MODE_CBC, iv)
+		return AES.new(self.uri.get_hd(), AES.MODE_CBC, iv)
+	def _load_metadata(self, md, mdencrypter):
+		""" Decrypts and parses a block of metadata """
+		try:
+			cmd=Metadata(mdencrypter.decrypt(md))
+		except:
+			raise IOError('The reference is not metadata: %s'%utils.format_error())
+		return cmd
+	def _segment_uri(self, i):
+		""" Returns the URI of the i-th block of metadata of the file """
+		u=URI(self.uri.uid,self.uri.nick,'')
+		u.hd=get_new_hasher(self.uri.get_hd()+'%d'%i).digest()[0:16]
+		return u
+	def _index_uri(self, l, i):
+		""" Returns the URI of the i-th node of the level l of the index """
+		u=URI(self.uri.uid,self.uri.nick,'')
+		u.hd=get_new_hasher(self.uri.get_hd()+'i%d.%d'%(l,i)).digest()[0:16]
+		return u
 	def flush(self, alldata=False):
 		""" Flushes the contents of the file.
 		Actually, only multiples of BLOCK_SIZE are flushed. If alldata is
 		set, all the data in the buffer is flushed (padding the last data to
-		a block of 1024 bytes) Warning: do NOT use alldata=True except
+		a block of BLOCK_SIZE bytes) Warning: do NOT use alldata=True except
 		in the last block of the file (close() internally calls to
 		flush(True) """
-		if self.closed: raise IOError('Closed')
-		if not self.mode == 'w': raise IOError('In read mode')
+		if self.closed: raise ValueError('I/O operation on closed file')
+		# io.BufferedReader flushes the files in read mode too
+		if not self.writable(): return
 		logger.info('Flushing %s'%self.uri.get_readable())
+		if self.mode == 'r+':
+			self._flush_update()
+			return
 		
+		# find the blocks to flush as pairs (start, length)
 		bl = len(self.buffer)
-		fl = bl / self.BLOCK_SIZE
-		if alldata and not bl == fl * self.BLOCK_SIZE: fl = fl + 1
+		blocks = []
+		if self.chunker:
+			start = 0
+			n = self.chunker.cut(self.buffer)
+			while n:
+				blocks.append((start, n))
+				start += n
+				n = self.chunker.cut(self.buffer, start)
+			if alldata and start < bl: blocks.append((start, bl - start))
+		else:
+			fl = bl / self.BLOCK_SIZE
+			if alldata and not bl == fl * self.BLOCK_SIZE: fl = fl + 1
+			for i in range(0, fl):
+				blocks.append((i * self.BLOCK_SIZE, min(self.BLOCK_SIZE, bl - i * self.BLOCK_SIZE)))
 		
-		for i in range(0,fl):
-			p = ''.join(self.buffer[i * self.BLOCK_SIZE:(i + 1) * 1024])
-			if len(p) < self.BLOCK_SIZE:
-				# pad random data at the end of the block
-				p += utils.random_string(self.BLOCK_SIZE-len(p))
-			# encrypt data if there is a crypter
-			if self.crypter: p = self.crypter.encrypt(p)
-			# create a random nick and calculate the hash of the part
+		# the last block of the file saves its length, so it is padded
+		# only to the size of the blocks of AES
+		short = alldata and blocks and blocks[-1][1] < self.BLOCK_SIZE
+		# the view must be released before resizing the buffer
+		view = memoryview(self.buffer)
+		n = len(self.parts)
+		encoded = self._encode_parts([(view[blocks[k][0]:sum(blocks[k])].tobytes(), short and k == len(blocks) - 1, n + k) for k in range(0, len(blocks))])
+		del view
+		items = []
+		for part, u, p in encoded:
+			if self.hasher: self.hasher.update(p)
+			logger.info('Saving part ' + u.get_static())
+			items.append((u.get_hd(), p, u.nick))
+			self.parts.append(part)
+		if self.DEDUP and items:
+			items = self._dedup(items)
+		# Save the parts in the DHT
+		if items: self._put_parts(items)
+		
+		# remove the flushed blocks in a single operation
+		if blocks: del self.buffer[:blocks[-1][0] + blocks[-1][1]]
+
+	def _encode_part(self, p, explicit=False, i=None):
+		""" Compresses, pads and encrypts the data of a block. Returns
+		the Part that references the block, its URI and the data to save.
+		If explicit, the length of the data is saved in the Part. i is
+		the index of the part in the file """
+		return self._encode_parts([(p, explicit, i)])[0]
+	def _encode_parts(self, blocks):
+		""" Encodes a list of blocks (data, explicit, i) as
+		_encode_part(). If there is a crypto pool, it encrypts the blocks
+		encrypted on their own and hashes all the blocks at once """
+		encoded = [self._prepare_part(p, explicit) + [i] for p, explicit, i in blocks]
+		keys = [self._block_key(e[0], e[3]) for e in encoded]
+		if self._use_pool(len(encoded)):
+			# the blocks in the CBC chain of the file are encrypted here, in order
+			for e, k in zip(encoded, keys):
+				if not k and self.crypter: e[2] = self._part_crypter(e[0], e[3]).encrypt(e[2])
+			done = self._crypt_pool([(True, k and k[0], k and k[1], e[2], self._mac(e[0])) for e, k in zip(encoded, keys)])
+			for e, (d, h) in zip(encoded, done):
+				if d is not None: e[2] = d
+				e[0].hash = h
+		else:
+			for e in encoded:
+				part, u, p, i = e
+				if part.key or self.crypter: e[2] = self._part_crypter(part, i).encrypt(p)
+				part.hash = self._hash_part(part, e[2])
+		return [(part, u, p) for part, u, p, i in encoded]
+	def _prepare_part(self, p, explicit):
+		""" Compresses and pads the data of a block, and chooses its
+		URI. Returns the list [part, uri, data] """
+		part = Part()
+		# the length of chunks is needed to remove their padding
+		if self.chunker or explicit: part.length = len(p)
+		if self.COMPRESS and utils.entropy(p) < COMPRESS_ENTROPY:
+			z = zlib.compress(p, self.COMPRESS)
+			if len(z) + 16 < len(p):
+				p = z
+				part.flags += 'z'
+		# pad the block up to BLOCK_SIZE, or to the size of the blocks
+		# of AES for chunks and compressed blocks. The padding of
+		# convergent blocks must not be random
+		if part.length is not None or part.flags:
+			padding = -len(p) % 16
+		else:
+			padding = self.BLOCK_SIZE - len(p)
+		if padding and self.DEDUP:
+			p += '\0' * padding
+		elif padding:
+			p += utils.random_bytes(padding)
+		if self.DEDUP:
+			# convergent encryption: the key depends on the content
+			part.key = get_new_hasher((self.keys[1] or '') + p).digest()[0:16]
+			u = convergent_uri(part.key)
+		else:
+			# encrypt data if there is a crypter, with a random URI
 			u = random_uri(self.config)
-			self.hasher.update(p)
+			if self.crypter and self.CRYPTO == 'block': part.flags += 'b'
+			if self.crypter and self.AEAD: part.flags += 'a'
+		part.hd, part.nick = u.hd, u.nick
+		return [part, u, p]
+	def _decode_part(self, part, d, i=None, decrypted=False):
+		""" Decrypts, decompresses and removes the padding of the data
+		of the i-th part. Chained parts must be decoded in order. If
+		decrypted, the data is already decrypted """
+		c = None
+		if not decrypted: c = self._part_crypter(part, i)
+		if c: d = c.decrypt(d)
+		if 'z' in part.flags: d = zlib.decompressobj().decompress(d)
+		if dfs.block_cache and dfs.block_cache.plaintext:
+			dfs.block_cache.put(part.hd, d)
+		if part.length is not None: d = d[:part.length]
+		return d
+	def _cached(self, part):
+		""" Returns the decoded data of a part from the blocks cache,
+		or None if it is not there or the cache keeps encrypted blocks """
+		cache = dfs.block_cache
+		if not cache or not cache.plaintext: return None
+		d = cache.get(part.hd)
+		if d is not None and part.length is not None: d = d[:part.length]
+		return d
+	def _dedup(self, items):
+		""" Removes from a list of blocks (hd, data, nick) the blocks
+		that are already in the DHT, repeated in the list or being saved
+		by other files of this process. Blocks being saved by other
+		processes at the same time are sent twice: deduplication is
+		best-effort, but the DHT keeps a single copy of each block """
+		found = dfs.dht.has_many([(hd, nick) for hd, data, nick in items])
+		new = []
+		uploading_cond.acquire()
+		try:
+			for i in range(0, len(items)):
+				hd = items[i][0]
+				if not found[i] and not hd in uploading_blocks:
+					uploading_blocks.add(hd)
+					new.append(items[i])
+					continue
+				# the upload in flight may fail: keep the block
+				if not found[i]: self.deferred.append(items[i])
+				self.dedup_hits += 1
+				self.dedup_bytes += len(items[i][1])
+		finally:
+			uploading_cond.release()
+		return new
+	def _finish_deferred(self):
+		""" Waits for the uploads of other files with blocks of this
+		file, and saves the blocks that they could not save """
+		hds = set([hd for hd, data, nick in self.deferred])
+		uploading_cond.acquire()
+		try:
+			while hds & uploading_blocks: uploading_cond.wait()
+		finally:
+			uploading_cond.release()
+		found = dfs.dht.has_many([(hd, nick) for hd, data, nick in self.deferred])
+		missing = [self.deferred[i] for i in range(0, len(found)) if not found[i]]
+		self.deferred = []
+		if missing:
+			logger.warn('Saving again %d parts'%len(missing))
+			put_blocks(missing)
+	def _block_key(self, part, i):
+		""" Returns the pair (key, IV) of the i-th part if it is
+		encrypted on its own, or None """
+		if not SECURED: return None
+		if part.key: return part.key, '\0' * 16
+		if 'b' in part.flags and self.crypter:
+			return self.keys[1], get_new_hasher(self.keys[1] + '%d:'%i + part.hd).digest()[0:16]
+		return None
+	def _mac(self, part):
+		""" Returns the pair (key, hd) to authenticate an encrypted
+		part, or None if the part is not authenticated """
+		if not 'a' in part.flags or not self.keys[1]: return None
+		return get_new_hasher('mac:' + self.keys[1]).digest(), part.hd
+	def _hash_part(self, part, data):
+		""" Returns the hash of the encrypted data of a part: its tag,
+		for authenticated parts """
+		mac = self._mac(part)
+		if mac: return block_mac(mac[0], mac[1], data)
+		return get_new_hasher(data).digest()
+	def _check_part(self, part, data):
+		""" Returns True if the data of a block matches its hash. The
+		tag of authenticated blocks is checked with the key of the file """
+		if not 'a' in part.flags: return part.check(data)
+		if not self._mac(part): raise IOError('No key to authenticate %s'%part.get_static())
+		return hmac.compare_digest(self._hash_part(part, data), part.hash)
+	def _crypt_pool(self, items):
+		""" Encrypts or decrypts a list of blocks in the crypto pool, as
+		crypt_block(). Returns None if there is no pool, or too few
+		blocks to use it """
+		if not self._use_pool(len(items)): return None
+		pool = get_crypto_pool(self.CRYPTO_WORKERS)
+		return pool.map(crypt_block, items, max(1, len(items) / (4 * self.CRYPTO_WORKERS)))
+	def _use_pool(self, n):
+		""" Returns True if n blocks are sent to the crypto pool """
+		return self.CRYPTO_WORKERS and n > 1
+	def _part_crypter(self, part, i=None):
+		""" Returns the crypter of the i-th part: its convergent key, or
+		the crypter of the file """
+		if not part.key:
+			# independent and rewritten blocks start a new CBC chain
+			if 'b' in part.flags and self.crypter:
+				key, iv = self._block_key(part, i)
+				self.crypter = AES.new(key, AES.MODE_CBC, iv)
+			elif part.iv and self.crypter:
+				self.crypter = AES.new(self.keys[1], AES.MODE_CBC, part.iv)
+			return self.crypter
+		if not SECURED: return DummyEncrypter()
+		# the key is used only for this content: the IV can be fixed
+		key, iv = self._block_key(part, i)
+		return AES.new(key, AES.MODE_CBC, iv)
 
-			logger.info('Saving part ' + u.get_static())
-			# Save the part in the DHT
-			dfs.dht.put(u.get_hd(), p, u.nick)
+	def _put_parts(self, items):
+		""" Saves a list of parts (hd, data, nick) in the DHT. If
+		MAX_UPLOADS is set, the parts are saved in the background, waiting
+		for the oldest upload if there are already MAX_UPLOADS uploads
+		in flight """
+		if not self.MAX_UPLOADS:
+			try:
+				put_blocks(items)
+			except Exception, e:
+				# the parts are in File.parts already: close() must not
+				# save the metadata of the file
+				self.upload_errors.append(str(e))
+				raise
+			return
+		if not self.uploader: self.uploader = utils.WorkerPool(self.MAX_UPLOADS)
+		while len(self.uploading) >= self.MAX_UPLOADS:
+			self._wait_upload()
+		self.uploading.append(self.uploader.submit(put_blocks, items))
+	def _wait_upload(self):
+		""" Waits for the oldest upload in flight. Errors are saved
+		to be raised in close() """
+		job = self.uploading.pop(0)
+		try:
+			job.wait()
+		except Exception, e:
+			logger.warn('Error saving part: %s'%e)
+			self.upload_errors.append(str(e))
+	def _finish_uploads(self):
+		""" Waits for all the uploads in flight and stops the uploader.
+		Raises IOError if any part could not be saved """
+		while self.uploading: self._wait_upload()
+		if self.uploader:
+			self.uploader.close()
+			self.uploader = None
+		if self.deferred:
+			try:
+				self._finish_deferred()
+			except IOError, e:
+				self.upload_errors.append(str(e))
+		if self.upload_errors:
+			# the file cannot be recovered: do not save its metadata
+			self.closed = True
+			raise IOError('%d uploads of parts failed: %s'%(len(self.upload_errors), self.upload_errors[0]))
 
-			# Save the reference to the part
-			self.parts.append(u.get_static())
-		
-		if fl * self.BLOCK_SIZE >= bl:
-			self.buffer = []
+	def _part_index(self, pos):
+		""" Returns the index of the part with the byte pos """
+		i = min(bisect.bisect_right(self.offsets, pos) - 1, len(self.parts) - 1)
+		if self.parts[i] is None:
+			# the offsets of parts not loaded yet are not exact
+			k = self._find_segment(pos)
+			self._load_parts(self._segment_start(k), self._segment_start(k))
+			i = min(bisect.bisect_right(self.offsets, pos) - 1, len(self.parts) - 1)
+		return i
+	def _ciphertext(self, parts, keys=None):
+		""" Gets the data of a list of parts from the DHT. The data
+		is cached until the next flush or read. If keys has the (key, IV)
+		of the parts, the crypto pool decrypts them too """
+		missing = [n for n in range(0, len(parts)) if not parts[n].hd in self.ciphertexts]
+		if missing:
+			plain = []
+			if keys and self._use_pool(len(missing)):
+				data, plain = self._get_parts([parts[n] for n in missing], [keys[n] for n in missing])
+			else:
+				data = self._get_parts([parts[n] for n in missing])
+			for k in range(0, len(missing)):
+				hd = parts[missing[k]].hd
+				self.ciphertexts[hd] = data[k]
+				if plain and plain[k] is not None: self.decrypted[hd] = plain[k]
+		return [self.ciphertexts[p.hd] for p in parts]
+	def _old_iv(self, i):
+		""" Returns the IV of the i-th part as it was
+		encrypted: the last block of the previous part in the CBC chain """
+		if self._part(i).iv: return self.parts[i].iv
+		k = self._chain_prev(i)
+		if k < 0: return self.uri.get_hd()
+		return self._ciphertext([self.original[k]])[0][-16:]
+	def _part_data(self, i):
+		""" Returns the data of the i-th part. The last decoded parts
+		are kept in a small window, so reads of a few bytes do not
+		decode the same part again """
+		if i in self.pending: return self.pending[i]
+		p = self._part(i)
+		# blocks with convergent encryption may be in several parts,
+		# or in the same part with other lengths
+		n = self.offsets[i + 1] - self.offsets[i]
+		for j, hd, d in self.window:
+			if j == i and hd == p.hd and len(d) == n: return d
+		d = self._cached(p)
+		if d is None and p.hd in self.decrypted:
+			d = self._decode_part(p, self.decrypted.pop(p.hd), i, True)
+		elif d is None:
+			d = self._ciphertext([p])[0]
+			if self.crypter and p.chained():
+				self.crypter = AES.new(self.keys[1], AES.MODE_CBC, self._old_iv(i))
+			d = self._decode_part(p, d, i)
+		d = d[:n]
+		self.window.append((i, p.hd, d))
+		if len(self.window) > self.WINDOW: self.window.pop(0)
+		return d
+	def _modify_part(self, i):
+		""" In mode 'r+', returns the data of the i-th part to be modified """
+		if not i in self.pending:
+			self.pending[i] = bytearray(self._part_data(i))
+			self.touched.add(i)
+		return self.pending[i]
+	def _flush_update(self):
+		""" In mode 'r+', saves the modified parts. Each one of them
+		is encrypted on its own, or starts a new CBC chain with a random
+		IV. The next part, if it is chained and does not change, gets the
+		IV it was encrypted with """
+		if not self.pending: return
+		for i in self.pending.keys():
+			j = i + 1
+			if j < len(self.parts): self._part(j)
+			if self.crypter and j < min(len(self.parts), len(self.original)) and self.parts[j] is self.original[j] and \
+				not j in self.pending and self.parts[j].chained():
+				self.parts[j].iv = self._old_iv(j)
+				self.touched.add(j)
+		changed = sorted(self.pending.keys())
+		last = len(self.parts) - 1
+		explicit = dict([(i, self.parts[i].length is not None or (i == last and len(self.pending[i]) < self.BLOCK_SIZE)) for i in changed])
+		if self.crypter and self.CRYPTO == 'chain':
+			encoded = []
+			for i in changed:
+				iv = utils.random_bytes(16)
+				self.crypter = AES.new(self.keys[1], AES.MODE_CBC, iv)
+				part, u, p = self._encode_part(str(self.pending[i]), explicit[i], i)
+				if not part.key: part.iv = iv
+				encoded.append((part, u, p))
 		else:
-			self.buffer = self.buffer[fl * self.BLOCK_SIZE:]
+			encoded = self._encode_parts([(str(self.pending[i]), explicit[i], i) for i in changed])
+		items = []
+		for i in changed:
+			part, u, p = encoded.pop(0)
+			if self.hasher: self.hasher.update(p)
+			logger.info('Saving part ' + u.get_static())
+			items.append((u.get_hd(), p, u.nick))
+			self.parts[i] = part
+		if self.DEDUP: items = self._dedup(items)
+		if items: self._put_parts(items)
+		self.pending = {}
+		self.ciphertexts = {}
+		self.decrypted = {}
+	def _read_at(self, size=None):
+		""" Reads size bytes from the current position, or up to the
+		end of the file if size is None. Only the parts in that range are
+		requested to the DHT """
+		end = self.filelength
+		if size is not None: end = min(end, self.pos + size)
+		s = []
+		for d, start, n in self._read_parts(end):
+			s.append(str(d[start:start + n]))
+		return ''.join(s)
+	def _read_parts(self, end):
+		""" Iterates over the parts from the current position to end,
+		as tuples (data, start, length) with the range of the data of
+		each part that is read. The position moves after each part """
+		if self.pos >= end: return
+		first = self._part_index(self.pos)
+		last = self._part_index(end - 1)
+		# get all the parts at once, and the previous one in the CBC
+		# chain to decrypt the first one
+		self._load_parts(first, last)
+		wanted = [i for i in range(first, last + 1) if not i in self.pending]
+		if dfs.block_cache and dfs.block_cache.plaintext:
+			wanted = [i for i in wanted if not self.parts[i].hd in dfs.block_cache]
+		keys = [self._block_key(self.parts[i], i) for i in wanted]
+		wanted = [self.parts[i] for i in wanted]
+		p = self.parts[first]
+		if self.crypter and not first in self.pending and p.chained() and \
+			first < len(self.original) and p is self.original[first] and p in wanted:
+			k = self._chain_prev(first)
+			if k >= 0:
+				wanted.insert(0, self.original[k])
+				keys.insert(0, None)
+		if self.mode == 'r' and self.READAHEAD: self._read_ahead(first, last, end)
+		self._ciphertext(wanted, keys)
+		while self.pos < end:
+			i = self._part_index(self.pos)
+			n = min(end, self.offsets[i + 1]) - self.pos
+			start = self.pos - self.offsets[i]
+			d = self._part_data(i)
+			self.pos += n
+			yield d, start, n
+		# keep only the last part, to decrypt the next one, and the old
+		# data of the modified parts, that _old_iv() needs. Others are
+		# requested again if they are needed
+		keep = [self.parts[last].hd]
+		if self.mode == 'r+':
+			keep += [self.original[i].hd for i in self.pending if i < len(self.original) and self.original[i]]
+		self.ciphertexts = dict([(hd, self.ciphertexts[hd]) for hd in keep if hd in self.ciphertexts])
+		self.decrypted = {}
+	def _read_ahead(self, first, last, end):
+		""" Takes the parts first..last from the parts requested in
+		advance, and requests the next ones if the reads are sequential:
+		the read starts where the last one ended, or a bit before it, as
+		readline() does """
+		sequential = self.next_pos - self.BLOCK_SIZE <= self.pos <= self.next_pos
+		if not sequential:
+			# random access: the parts requested in advance are useless
+			self._cancel_read_ahead()
+			self.ahead = 1
+		self.next_pos = end
+		stalled = False
+		for i in range(first, last + 1):
+			job, n = self.prefetched.pop(i, (None, None))
+			if not job: continue
+			if not job.done(): stalled = True
+			hd = self.parts[i].hd
+			if n is None:
+				self.ciphertexts[hd] = job.wait()[0]
+				continue
+			data, plain = job.wait()
+			self.ciphertexts[hd] = data[n]
+			if plain[n] is not None: self.decrypted[hd] = plain[n]
+		if not sequential: return
+		if stalled: self.ahead = min(2 * self.ahead, self.READAHEAD)
+		if not self.prefetcher: self.prefetcher = utils.WorkerPool(self.READAHEAD)
+		self._load_parts(last + 1, min(last + self.ahead, len(self.parts) - 1))
+		cache = dfs.block_cache
+		new = []
+		for i in range(last + 1, min(last + 1 + self.ahead, len(self.parts))):
+			if cache and cache.plaintext and self.parts[i].hd in cache: continue
+			if not i in self.prefetched: new.append(i)
+		if self.CRYPTO_WORKERS and self.ahead > 1:
+			# the crypto pool checks and decrypts the parts in batches of
+			# half the window
+			if 2 * len(new) < self.ahead: return
+			job = self.prefetcher.submit(self._get_parts, [self.parts[i] for i in new],
+				[self._block_key(self.parts[i], i) for i in new])
+			for n in range(0, len(new)): self.prefetched[new[n]] = (job, n)
+			return
+		for i in new:
+			self.prefetched[i] = (self.prefetcher.submit(self._get_parts, [self.parts[i]]), None)
+	def _cancel_read_ahead(self):
+		""" Cancels the parts requested in advance """
+		for job, n in self.prefetched.values(): job.cancel()
+		self.prefetched = {}
+	def _write_update(self, data):
+		""" In mode 'r+', writes data in the current position """
+		if self.pos > self.filelength:
+			# fill the hole with zeros
+			data = '\0' * (self.pos - self.filelength) + data
+			self.pos = self.filelength
+		i = 0
+		while i < len(data):
+			if self.pos < self.filelength:
+				# overwrite an existing part
+				n = self._part_index(self.pos)
+				d = self._modify_part(n)
+				c = min(len(data) - i, self.offsets[n + 1] - self.pos)
+				start = self.pos - self.offsets[n]
+				d[start:start + c] = data[i:i + c]
+			else:
+				# grow the last part, or add a new one if it is complete
+				n = len(self.parts) - 1
+				if n < 0 or self.offsets[n + 1] - self.offsets[n] >= self.BLOCK_SIZE:
+					self.parts.append(Part())
+					self.offsets.append(self.filelength)
+					self.pending[n + 1] = bytearray()
+					n += 1
+				d = self._modify_part(n)
+				c = min(len(data) - i, self.BLOCK_SIZE - len(d))
+				d += data[i:i + c]
+				self.offsets[n + 1] += c
+				self.filelength += c
+			i += c
+			self.pos += c
+			if len(self.pending) * self.BLOCK_SIZE >= self.MAX_BUFFER: self.flush()
 
 	def _complete_read(self):
 		""" Reads the contents of the file."""
 		s = []
 		try:
 			# read and return the whole file
-			for p in self.parts:
-				logger.info('Reading part ' + p)
-				uri = uri_from_string(p)
-				d = dfs.dht.get(uri.get_hd(),uri.nick)
+			logger.info('Reading %d parts'%len(self.parts))
+			if self.parts: self._load_parts(0, len(self.parts) - 1)
+			cached = [self._cached(p) for p in self.parts]
+			missing = [i for i in range(0, len(cached)) if cached[i] is None]
+			# blocks encrypted on their own are decrypted by the crypto pool
+			# while it checks them
+			keys = [self._block_key(self.parts[i], i) for i in missing]
+			got, plain = self._get_parts([self.parts[i] for i in missing], keys)
+			data = dict(zip(missing, got))
+			plain = dict([(i, d) for i, d in zip(missing, plain) if d is not None])
+			chained = True
+			for i in range(0, len(cached)):
 				# TODO: do not decrypt now, but in the actual read
-				if self.crypter:	d = self.crypter.decrypt(d)
-				s.append(d)
+				p = self.parts[i]
+				if cached[i] is not None:
+					s.append(cached[i])
+					chained = False
+				elif i in plain:
+					s.append(self._decode_part(p, plain[i], i, True))
+					chained = False
+				else:
+					if not chained and self.crypter and p.chained():
+						# the previous part was not decrypted with the crypter
+						k = self._chain_prev(i)
+						if k in data:
+							self.crypter = AES.new(self.keys[1], AES.MODE_CBC, data[k][-16:])
+						else:
+							self.crypter = AES.new(self.keys[1], AES.MODE_CBC, self._old_iv(i))
+					chained = True
+					s.append(self._decode_part(p, data[i], i))
 			s=''.join(s)
-			self.eof = True
-			# TODO: check the file hashing before returning
 			return s[0:self.filelength]
 		except:
 			raise IOError('Cannot read: %s'%utils.format_error())
-	def read(self, size=0):
-		""" Reads the contents of the file. The first call reads the complete file, since
-		it may be suffled. """
-		# TODO: optionally use a temporal file instead of a memory buffer
-		if self.eof: return []
-		if self.closed: raise IOError,'Closed'
-		if not self.mode == 'r': raise IOError,'In write mode'
-
-		if len(self.buffer) == 0 and not self.eof:
-			self.buffer = self._complete_read()
-		r = None
-		if not size or size>len(self.buffer):
-			self.eof = True
-			r = self.buffer
-			self.buffer = None
+	def chunks(self, size=0):
+		""" Iterates over the file from the current position, in
+		pieces of at most size bytes (BLOCK_SIZE if 0). Only a few
+		parts are in memory at the same time """
+		if not size: size = self.BLOCK_SIZE
+		while True:
+			d = self.read(size)
+			if not d: break
+			yield d
+	def read(self, size=-1):
+		""" Reads size bytes from the current position, or up to the
+		end of the file if size is negative or None. Only the parts in
+		that range are requested to the DHT """
+		if self.closed: raise ValueError('I/O operation on closed file')
+		if not self.mode in ('r', 'r+'): raise IOError,'In write mode'
+		if size is None or size < 0: size = None
+		if self.mode == 'r' and size is None and self.pos == 0:
+			# the complete file: get all the parts at once
+			r = self._complete_read()
+			self.pos = self.filelength
 		else:
-			r = self.buffer[0:size]
-			self.buffer = self.buffer[size:]
+			r = self._read_at(size)
+		self.eof = self.pos >= self.filelength
 		return r
+	def readinto(self, b):
+		""" Reads up to len(b) bytes from the current position into the
+		writable buffer b, and returns the number of bytes read. The
+		crypto module cannot decrypt into a buffer, so the decoded data
+		of each part is copied once into b """
+		if self.closed: raise ValueError('I/O operation on closed file')
+		if not self.mode in ('r', 'r+'): raise IOError,'In write mode'
+		m = memoryview(b)
+		k = 0
+		for d, start, n in self._read_parts(min(self.filelength, self.pos + len(m))):
+			m[k:k + n] = memoryview(d)[start:start + n]
+			k += n
+		self.eof = self.pos >= self.filelength
+		return k
+	def readline(self, limit=-1):
+		""" Reads up to the next end of line, or limit bytes. The end
+		of line is searched in the decoded parts, so only the bytes of the
+		line are copied """
+		if self.closed: raise ValueError('I/O operation on closed file')
+		if not self.mode in ('r', 'r+'): raise IOError,'In write mode'
+		end = self.filelength
+		if limit is not None and limit >= 0: end = min(end, self.pos + limit)
+		s = []
+		found = False
+		while self.pos < end and not found:
+			i = self._part_index(self.pos)
+			for d, start, n in self._read_parts(min(end, self.offsets[i + 1])):
+				j = d.find('\n', start, start + n)
+				found = j >= 0
+				if found: n = j + 1 - start
+				s.append(str(d[start:start + n]))
+			# leave the rest of the part for the next read
+			if found: self.pos = self.offsets[i] + j + 1
+		self.eof = self.pos >= self.filelength
+		return ''.join(s)
+	def readlines(self, hint=-1):
+		""" Reads the lines up to the end of the file, or until
+		hint bytes are read """
+		lines = []
+		n = 0
+		for l in self:
+			lines.append(l)
+			n += len(l)
+			if hint > 0 and n >= hint: break
+		return lines
+	def __iter__(self):
+		return self
+	def next(self):
+		l = self.readline()
+		if not l: raise StopIteration
+		return l
+	def readable(self):
+		return self.mode in ('r', 'r+')
+	def writable(self):
+		return self.mode in ('w', 'a', 'r+')
+	def seekable(self):
+		return self.mode in ('r', 'r+')
+	def isatty(self):
+		return False
+	def fileno(self):
+		raise IOError('File has no file descriptor')
+	def __enter__(self):
+		return self
+	def __exit__(self, *args):
+		self.close()
 	def write(self,data):
-		""" Writes data in the file """
-		if self.closed: raise IOError,'Closed'
-		if not self.mode == 'w': raise IOError,'In read mode'
+		""" Writes data in the file and returns the number of bytes
+		written """
+		if self.closed: raise ValueError('I/O operation on closed file')
+		if not self.mode in ('w', 'a', 'r+'): raise IOError,'In read mode'
+		if self.mode == 'r+':
+			self._write_update(data)
+			return len(data)
 		self.filelength = self.filelength+len(data)
-		self.buffer.extend(data)
-		if len(self.buffer) > self.MAX_BUFFER: self.flush()
+		# copy the data in slices of at most MAX_BUFFER bytes, so a
+		# big write never holds more than MAX_BUFFER in the buffer
+		i = 0
+		while i < len(data):
+			room = max(self.MAX_BUFFER - len(self.buffer), self.BLOCK_SIZE)
+			self.buffer += data[i:i + room]
+			i += room
+			if len(self.buffer) >= self.MAX_BUFFER: self.flush()
+		return len(data)
+	def writelines(self, lines):
+		""" Writes a sequence of strings in the file """
+		for l in lines: self.write(l)
 	def __del__(self):
 		""" Closes the file when there is no further reference """
 		try:
@@ -545,7 +1976,49 @@ class File():
 			logger.warn('Error closing file %s'%self.uri.get_readable())
 			utils.format_error()
 	
-	# Not supported methods:
-	def seek(offset, whence=None): raise IOError('seek() not supported')
-	def tell(): raise IOError('tell() not supported')
-	def truncate(size=0): raise IOError('truncate() not supported')
+	def seek(self, offset, whence=0):
+		""" Moves the current position. Only in modes 'r' and 'r+' """
+		if self.closed: raise ValueError('I/O operation on closed file')
+		if not self.mode in ('r', 'r+'): raise IOError('seek() not supported')
+		if whence == 1:
+			offset += self.pos
+		elif whence == 2:
+			offset += self.filelength
+		if offset < 0: raise IOError('Invalid offset')
+		self.pos = offset
+		return self.pos
+	def tell(self):
+		""" Returns the current position """
+		if self.mode in ('r', 'r+'): return self.pos
+		return self.filelength
+	def truncate(self, size=None):
+		""" Truncates the file to size bytes, or to the current position,
+		and returns the new size. Only in mode 'r+' """
+		if self.closed: raise ValueError('I/O operation on closed file')
+		if not self.mode == 'r+': raise IOError('truncate() not supported')
+		if size is None: size = self.pos
+		if size >= self.filelength:
+			pos = self.pos
+			self.seek(size)
+			self._write_update('')
+			self.pos = pos
+			return size
+		if size == 0:
+			n = 0
+		else:
+			# cut the part with the last byte
+			i = self._part_index(size - 1)
+			d = self._modify_part(i)
+			del d[size - self.offsets[i]:]
+			n = i + 1
+		del self.parts[n:]
+		del self.offsets[n + 1:]
+		self.offsets[n] = size
+		for j in self.pending.keys():
+			if j >= n: del self.pending[j]
+		self.touched = set([j for j in self.touched if j < n])
+		self.dirty = min(self.dirty, n)
+		self.filelength = size
+		return size
+
+io.RawIOBase.register(File)
@@ -22,6 +22,11 @@ import ConfigParser
 import os
 import random
 import base64
+import math
+import threading
+import Queue
+import time
+import collections
 try:
 	from Crypto.Cipher import AES
 	SECURED=True
@@ -101,11 +106,13 @@ class Config:
 		except:
 			(section,property)=(ConfigParser.DEFAULTSECT,key)
 		# convert integers and booleans into strings
-		if not value: value=''
-		if type(value)==int: value='%d'%value
 		if type(value)==bool:
-			value='true'
-			if not value: value='false'
+			if value:
+				value='true'
+			else:
+				value='false'
+		if type(value)==int: value='%d'%value
+		if not value: value=''
 		# create the section, if not pressent
 		if not self.config.has_section(section):
 			self.config.add_section(section)
@@ -169,15 +176,281 @@ def format_error():
 	return '%s (file=%s line=%s text="%s")'%(ei[1],fn,ln,t)
 
 random_string_seed='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789abcdefghijklmnopqrstuvwxyz'
+
+class RandomPool:
+	""" A source of cryptographically strong random bytes. Bytes are read
+	from os.urandom in large chunks and kept in a buffer for later calls.
+	
+	>>> len(RandomPool().get_bytes(20))
+	20
+	>>> s=RandomPool().get_printable(100)
+	>>> len(s), s.isalnum()
+	(100, True)
+	"""
+	def __init__(self, chunk=65536):
+		""" chunk is the number of bytes read from the system each time """
+		self.chunk = chunk
+		self.buffer = ''
+		self.pos = 0
+		self.lock = threading.Lock()
+		# printable strings are made translating random bytes to the
+		# characters of random_string_seed. Bytes over the last multiple
+		# of len(random_string_seed) are deleted, to get an uniform distribution
+		n = len(random_string_seed)
+		self.valid = 256 - 256 % n
+		self.table = ''.join([random_string_seed[i % n] for i in range(0, 256)])
+		self.deleted = ''.join([chr(i) for i in range(self.valid, 256)])
+	def get_bytes(self, length):
+		""" Returns a string of length random bytes """
+		if length >= self.chunk: return os.urandom(length)
+		self.lock.acquire()
+		try:
+			if self.pos + length > len(self.buffer):
+				self.buffer = self.buffer[self.pos:] + os.urandom(self.chunk)
+				self.pos = 0
+			r = self.buffer[self.pos:self.pos + length]
+			self.pos += length
+			return r
+		finally:
+			self.lock.release()
+	def get_printable(self, length):
+		""" Returns a string of length random characters of random_string_seed """
+		s = []
+		missing = length
+		while missing > 0:
+			# read some more bytes than needed, since some of them are deleted
+			b = self.get_bytes(missing * 256 / self.valid + 8)
+			b = b.translate(self.table, self.deleted)[:missing]
+			s.append(b)
+			missing -= len(b)
+		return ''.join(s)
+
+random_pool = RandomPool()
+""" The default source of random data """
+
 def random_string(length,printable=True):
 	"Returns a random string with a given length, optionally printable"
-	s=[]
-	for i in range(0,length):
-		if printable:
-			s.append(random.choice(random_string_seed))
-		else:
-			s.append(chr(random.randint(0,255)))
-	return ''.join(s)
+	if length <= 0: return ''
+	if printable:
+		return random_pool.get_printable(length)
+	else:
+		return random_pool.get_bytes(length)
+
+def random_bytes(length):
+	" Returns a string of random bytes with a given length "
+	return random_string(length, printable=False)
+
+class Chunker:
+	""" Finds content defined boundaries in a stream of bytes, so an
+	insertion in the stream only changes the chunks around it. It uses
+	a gear rolling hash: a boundary is found after a byte where the
+	highest bits of the hash are zero.
+	
+	>>> c=Chunker(64, 256, 1024)
+	>>> data=bytearray(RandomPool().get_bytes(10000))
+	>>> n=c.cut(data)
+	>>> n>=64 and n<=1024
+	True
+	"""
+	# the hash is kept in 31 bits to use only Python integers
+	HASH_BITS=31
+	HASH_MASK=(1<<31)-1
+	def __init__(self, minsize, avgsize, maxsize):
+		""" minsize and maxsize are the limits of the length of a chunk.
+		avgsize is the expected length, rounded to a power of 2 """
+		self.min = max(1, minsize)
+		self.max = max(self.min, maxsize)
+		bits = 0
+		while (2 << bits) <= avgsize - self.min: bits += 1
+		self.mask = ((1 << bits) - 1) << (self.HASH_BITS - bits)
+		# the table must be the same in every run to find the same boundaries
+		r = random.Random(0x646673)
+		self.gear = [r.randint(0, self.HASH_MASK) for i in range(0, 256)]
+	def cut(self, data, start=0):
+		""" Returns the length of the chunk of the bytearray data that
+		begins at start, or 0 if data ends before a boundary """
+		end = min(len(data), start + self.max)
+		if end - start < self.min: return 0
+		# bytes before the last HASH_BITS ones do not affect the hash: skip them
+		pos = max(start, start + self.min - self.HASH_BITS)
+		h = 0
+		mask = self.mask
+		gear = self.gear
+		for b in data[pos:end]:
+			h = ((h << 1) + gear[b]) & self.HASH_MASK
+			pos += 1
+			if not h & mask and pos - start >= self.min: return pos - start
+		if pos - start == self.max: return self.max
+		return 0
+
+def entropy(data, sample=1024):
+	""" Estimates the entropy of a string in bits per byte, using up to
+	sample bytes spread over the string.
+	
+	>>> entropy('a'*1000)
+	0.0
+	>>> entropy(RandomPool().get_bytes(100000)) > 7.5
+	True
+	"""
+	if not data: return 0.0
+	step = max(1, len(data) / sample)
+	data = data[::step]
+	n = float(len(data))
+	e = 0.0
+	for c in set(data):
+		f = data.count(c) / n
+		e -= f * math.log(f, 2)
+	return e
+
+class Job:
+	""" A task sent to a WorkerPool. Call to wait() to get its result """
+	def __init__(self, func, args):
+		self.func = func
+		self.args = args
+		self.result = None
+		self.error = None
+		self.cancelled = False
+		self.event = threading.Event()
+	def run(self):
+		""" Runs the task. Errors are saved to be raised in wait() """
+		if not self.cancelled:
+			try:
+				self.result = self.func(*self.args)
+			except:
+				import sys
+				self.error = sys.exc_info()
+		self.event.set()
+	def cancel(self):
+		""" The task will not run if it has not started yet """
+		self.cancelled = True
+	def done(self):
+		""" Returns True if the task has finished """
+		return self.event.isSet()
+	def wait(self):
+		""" Waits until the task finishes and returns its result. If the task
+		raised an exception, it is raised again here """
+		self.event.wait()
+		if self.error: raise self.error[0], self.error[1], self.error[2]
+		return self.result
+
+class WorkerPool:
+	""" A pool of threads that run tasks in the background.
+	
+	>>> pool=WorkerPool(2)
+	>>> pool.submit(len, 'data').wait()
+	4
+	>>> pool.close()
+	"""
+	def __init__(self, workers):
+		self.queue = Queue.Queue()
+		self.threads = []
+		for i in range(0, workers):
+			t = threading.Thread(target=self.__work)
+			t.setDaemon(True)
+			t.start()
+			self.threads.append(t)
+	def __work(self):
+		job = self.queue.get()
+		while job:
+			job.run()
+			job = self.queue.get()
+	def submit(self, func, *args):
+		""" Queues the call func(*args) and returns its Job """
+		job = Job(func, args)
+		self.queue.put(job)
+		return job
+	def close(self):
+		""" Finishes the threads after the queued tasks """
+		for t in self.threads: self.queue.put(None)
+		self.threads = []
+
+class BlockCache:
+	""" A cache of blocks shared by the files of the process, with a
+	limit of bytes. The least recently used blocks are removed first.
+	If plaintext is True, the cache keeps the decrypted blocks: reads
+	are faster, but the data of the files is in memory. If ttl is not
+	0, blocks older than ttl seconds are removed. It is safe to use from
+	several threads.
+	
+	>>> c=BlockCache(10)
+	>>> c.put('a', '12345'); c.put('b', '12345'); c.get('a')
+	'12345'
+	>>> c.put('c', '1'); print c.get('b')
+	None
+	>>> c.hits, c.misses, c.evictions, c.used
+	(1, 1, 1, 6)
+	"""
+	def __init__(self, size, plaintext=False, ttl=0):
+		self.size = size
+		self.plaintext = plaintext
+		self.ttl = ttl
+		# the blocks, the most recently used last
+		self.blocks = collections.OrderedDict()
+		# time when each block was saved
+		self.times = {}
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+	def get(self, key):
+		""" Returns the block with this key, or None """
+		self.lock.acquire()
+		try:
+			d = self.blocks.get(key)
+			if d is not None and self.ttl and time.time() - self.times[key] > self.ttl:
+				self.__remove(key)
+				d = None
+			if d is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				# move the block to the end
+				self.blocks[key] = self.blocks.pop(key)
+			return d
+		finally:
+			self.lock.release()
+	def put(self, key, data):
+		""" Saves a block, removing old blocks to make room for it.
+		Blocks bigger than the cache are not saved """
+		if len(data) > self.size: return
+		self.lock.acquire()
+		try:
+			if key in self.blocks: self.__remove(key)
+			self.blocks[key] = data
+			self.times[key] = time.time()
+			self.used += len(data)
+			while self.used > self.size:
+				old, d = self.blocks.popitem(last=False)
+				self.used -= len(d)
+				self.times.pop(old)
+				self.evictions += 1
+		finally:
+			self.lock.release()
+	def remove(self, key):
+		""" Removes a block, if it is in the cache """
+		self.lock.acquire()
+		try:
+			if key in self.blocks: self.__remove(key)
+		finally:
+			self.lock.release()
+	def __remove(self, key):
+		self.used -= len(self.blocks.pop(key))
+		self.times.pop(key)
+	def __contains__(self, key):
+		return key in self.blocks
+	def clear(self):
+		""" Removes all the blocks """
+		self.lock.acquire()
+		try:
+			self.blocks = collections.OrderedDict()
+			self.times = {}
+			self.used = 0
+		finally:
+			self.lock.release()
+	def __str__(self):
+		return '%d blocks, %d bytes: %d hits, %d misses, %d evictions'%(
+			len(self.blocks), self.used, self.hits, self.misses, self.evictions)
 
 def password_to_key(pwd):
 	""" Returns a 16B key (suitable for AES) based on a password """
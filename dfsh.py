@@ -7,7 +7,27 @@ import logging
 import dfs
 import dfs.utils
 from optparse import OptionParser
-import sys, os
+import sys, os, time
+
+def transfer(src, dst, options):
+	""" Copies the file object src into dst in chunks of options.chunk
+	bytes, so the memory used does not depend on the size of the file.
+	If options.progress is set, reports the bytes copied and the
+	throughput in the standard error. Returns the bytes copied """
+	total = 0
+	start = last = time.time()
+	data = src.read(options.chunk)
+	while data:
+		dst.write(data)
+		total += len(data)
+		if options.progress and time.time() - last > 1:
+			last = time.time()
+			sys.stderr.write('\r%d KB (%.1f KB/s)   '%(total / 1024, total / 1024.0 / (last - start)))
+		data = src.read(options.chunk)
+	if options.progress:
+		t = max(time.time() - start, 0.001)
+		sys.stderr.write('\r%d KB in %.1f s (%.1f KB/s)\n'%(total / 1024, t, total / 1024.0 / t))
+	return total
 
 def shell(options, args):
 	import dfs.filesystem
@@ -62,16 +82,20 @@ def shell(options, args):
 			if len(file) > 1: remotefilename = file[1]
 			u = dfs.filesystem.random_uri(self.keys)
 			f = dfs.filesystem.File(u, mode='w', config=self.config, keys=self.keys)
-			f.write(open(file[0], 'r').read())
+			lf = open(file[0], 'rb')
+			transfer(lf, f, options)
+			lf.close()
 			f.close()
 			self.current.add(f, remotefilename)
 		def get(self, file):
 			""" Gets a file from the DFS """
-			u = dfs.filesystem.uri_from_string(self.current.files[file[0]], keys=self.keys, config=self.config)
+			u = dfs.filesystem.uri_from_string(self.current.files[file[0]], config=self.config)
 			localfilename = file[0]
 			if len(file) > 1: localfilename = file[1]
 			f = dfs.filesystem.File(u, mode='r', config=self.config, keys=self.keys)
-			open(localfilename,'w').write(f.read())
+			lf = open(localfilename, 'wb')
+			transfer(f, lf, options)
+			lf.close()
 			f.close()
 		def rm(self, name):
 			""" Removes a file from the DFS """
@@ -127,12 +151,17 @@ def copy(options, args):
 		if dfs.filesystem.uri_from_string(file2):
 			# writing
 			f = dfs.filesystem.File(file2, 'w')
-			f.write(open(file1, 'r').read())
+			lf = open(file1, 'rb')
+			transfer(lf, f, options)
+			lf.close()
 			f.close()
 		else:
 			# reading
 			f = dfs.filesystem.File(file1, 'r')
-			open(file2, 'w').write(f.read())
+			lf = open(file2, 'wb')
+			transfer(f, lf, options)
+			lf.close()
+			f.close()
 	except:
 		sys.stderr.write(dfs.utils.format_error() + '\n')
 
@@ -172,7 +201,6 @@ def configure(options, args):
 
 		# Filesystem configuration
 		c.set('File:block', 1024)
-		c.set('File:descPerMetapart', 12)
 		c.set('File:maxbuffer', 4096)
 
 		# DHT configuration
@@ -243,6 +271,10 @@ if __name__ == '__main__':
 		help='Log messages')
 	parser.add_option('-l','--logfile', dest = 'logfile', metavar = 'FILE',
 		help='Log messages in FILE', default=dfs.default_log_file)
+	parser.add_option('-b', '--chunk', dest='chunk', type='int', metavar='BYTES',
+		help='Copy files in chunks of BYTES', default=65536)
+	parser.add_option('-P', '--progress', action='store_true', dest='progress',
+		help='Report the progress of copies', default=False)
 	parser.add_option('-S','', dest='nosec', help='Development mode',
 		action='store_true', default=False)
 	(options, args) = parser.parse_args()
@@ -275,6 +307,12 @@ if __name__ == '__main__':
 		dfs.dht = dfs.DHT.LocalDHT(dfs.default_config)
 	else:
 		dfs.dht = dfs.DHT.NetClientDHT(ring_node)
+	if dfs.default_config.getint('Cache:size', 0):
+		dfs.block_cache = dfs.utils.BlockCache(dfs.default_config.getint('Cache:size', 0),
+			dfs.default_config.getbool('Cache:plaintext', False))
+	if dfs.default_config.getint('Cache:metadata', 0):
+		dfs.metadata_cache = dfs.utils.BlockCache(dfs.default_config.getint('Cache:metadata', 0),
+			ttl=dfs.default_config.getint('Cache:ttl', 30))
 	
 	if len(args) == 0:
 		parser.error('You must supply a command to run')
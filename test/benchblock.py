@@ -0,0 +1,50 @@
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dfs
+from dfs.filesystem import File, uri_from_string
+from dfs.utils import Config
+from dfs.DHT import MemoryDHT
+
+# Writes and reads a file with several block sizes, and reports the
+# number of values saved in the DHT and the bytes saved per byte of
+# the file, and the bytes saved for a file of 5 bytes. The last block
+# of a file is padded only to 16 bytes, so small files do not cost a
+# whole block. Usage: benchblock.py [MB]
+
+class CountingDHT(MemoryDHT):
+	""" A MemoryDHT that counts the values and bytes saved """
+	def __init__(self):
+		MemoryDHT.__init__(self)
+		self.values = self.bytes = 0
+	def put_many(self, items):
+		self.values += len(items)
+		self.bytes += sum([len(data) for id, data, key in items])
+		return MemoryDHT.put_many(self, items)
+
+mb = 8
+if len(sys.argv) > 1: mb = int(sys.argv[1])
+data = os.urandom(mb * 1024 * 1024)
+
+print '%10s %10s %12s %10s %10s %12s' % ('block', 'values', 'bytes/byte', 'write MB/s', 'read MB/s', '5B file')
+for block in (1024, 4096, 65536, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+	dfs.default_config = Config().set('Main:UID', 'bench').set('Main:nick', 'bench')
+	dfs.default_config.set('File:block', block)
+	dfs.dht = CountingDHT()
+	t = time.time()
+	f = File(uri_from_string('dfs://bench/benchblock'), 'w')
+	f.write(data)
+	f.close()
+	tw = time.time() - t
+	t = time.time()
+	f = File(uri_from_string('dfs://bench/benchblock'), 'r')
+	if f.read() != data: print 'Error reading with blocks of %d bytes' % block
+	f.close()
+	tr = time.time() - t
+	values, stored = dfs.dht.values, dfs.dht.bytes
+	dfs.dht = CountingDHT()
+	f = File(uri_from_string('dfs://bench/small'), 'w')
+	f.write('small')
+	f.close()
+	print '%10d %10d %12.4f %10.2f %10.2f %12d' % (block, values,
+		float(stored) / len(data), mb / tw, mb / tr, dfs.dht.bytes)
@@ -0,0 +1,52 @@
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dfs
+dfs.NO_SECURITY = False
+import dfs.DHT, dfs.utils
+import dfs.filesystem
+from dfs.filesystem import File, uri_from_string, KEY_NAMES
+from dfs.utils import Config
+
+# Measures writing and reading a file with a pool of crypto processes of
+# several sizes. The DHT is in memory, so the time is mostly encryption
+# and hashing. Usage: benchcrypto.py [MB] [block]
+
+if not dfs.filesystem.SECURED:
+	print 'The crypto module is not available'
+	sys.exit(1)
+
+mb = 16
+block = 64 * 1024
+if len(sys.argv) > 1: mb = int(sys.argv[1])
+if len(sys.argv) > 2: block = int(sys.argv[2])
+
+dfs.default_config = Config().set('Main:UID', 'bench').set('Main:nick', 'bench')
+for k in KEY_NAMES: dfs.default_config.set_key(k, os.urandom(16))
+dfs.default_config.set('File:block', block)
+dfs.default_config.set('File:maxbuffer', 4 * 1024 * 1024)
+dfs.dht = dfs.DHT.MemoryDHT()
+
+data = os.urandom(mb * 1024 * 1024)
+try:
+	import multiprocessing
+	cores = multiprocessing.cpu_count()
+except:
+	cores = 1
+print '%d MB in blocks of %d bytes, %d cores' % (mb, block, cores)
+for workers in sorted(set([0, 1, 2, 4, cores])):
+	dfs.default_config.set('File:cryptoworkers', workers)
+	# start the processes of the pool before measuring
+	if workers: dfs.filesystem.get_crypto_pool(workers)
+	t = time.time()
+	f = File(uri_from_string('dfs://bench/benchcrypto'), 'w')
+	f.write(data)
+	f.close()
+	w = time.time() - t
+	t = time.time()
+	f = File(uri_from_string('dfs://bench/benchcrypto'), 'r')
+	assert f.read() == data
+	f.close()
+	r = time.time() - t
+	print 'workers=%-2d write %6.1f MB/s   read %6.1f MB/s' % (workers, mb / w, mb / r)
+	dfs.filesystem.close_crypto_pools()
@@ -0,0 +1,45 @@
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dfs
+import dfs.DHT, dfs.utils
+from dfs.filesystem import File, Dir, create_dir, uri_from_string
+from dfs.utils import Config
+
+# Counts the blocks requested to the DHT to list a directory several
+# times, with and without the caches of metadata and blocks.
+# Usage: benchopen.py [files] [listings]
+
+class CountDHT(dfs.DHT.MemoryDHT):
+	""" A MemoryDHT that counts the blocks requested """
+	gets = 0
+	def get_many(self, ids):
+		CountDHT.gets += len(ids)
+		return dfs.DHT.MemoryDHT.get_many(self, ids)
+
+files = 50
+listings = 10
+if len(sys.argv) > 1: files = int(sys.argv[1])
+if len(sys.argv) > 2: listings = int(sys.argv[2])
+
+dfs.default_config = Config().set('Main:UID', 'bench').set('Main:nick', 'bench')
+dfs.dht = CountDHT()
+
+d = create_dir('bench', atomic=False)
+for i in range(0, files):
+	f = File(uri_from_string('dfs://bench/file%d' % i), 'w')
+	f.write('data')
+	f.close()
+	d.add(f, 'file%d' % i)
+d.close()
+
+for cached in (False, True):
+	if cached:
+		dfs.metadata_cache = dfs.utils.BlockCache(1024 * 1024, ttl=30)
+		dfs.block_cache = dfs.utils.BlockCache(1024 * 1024)
+	CountDHT.gets = 0
+	t = time.time()
+	for i in range(0, listings):
+		assert len(Dir(d.uri).list()) == files
+	t = time.time() - t
+	print 'cache=%-5s %d listings: %4d blocks requested, %.3f s' % (cached, listings, CountDHT.gets, t)
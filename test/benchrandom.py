@@ -0,0 +1,29 @@
+import sys, os, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dfs import utils
+
+# Compares the generation of random data with dfs.utils against the
+# former implementation, that chose characters one by one
+
+def old_random_string(length, printable=True):
+	s = []
+	for i in range(0, length):
+		if printable:
+			s.append(random.choice(utils.random_string_seed))
+		else:
+			s.append(chr(random.randint(0, 255)))
+	return ''.join(s)
+
+def bench(name, func, length, printable, n):
+	t = time.time()
+	for i in range(0, n):
+		func(length, printable)
+	t = time.time() - t
+	print '%-8s %6dB printable=%-5s %8.1f us/call %8.2f MB/s' % (name, length,
+		printable, t * 1e6 / n, length * n / t / 1e6)
+
+for length, n in ((6, 20000), (16, 20000), (1000, 1000), (65536, 20)):
+	for printable in (True, False):
+		bench('old', old_random_string, length, printable, n)
+		bench('utils', utils.random_string, length, printable, n)
@@ -0,0 +1,50 @@
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dfs
+import dfs.DHT, dfs.utils
+from dfs.filesystem import File, uri_from_string
+from dfs.utils import Config
+
+# Measures sequential reads over a DHT with a fixed latency per request,
+# with several values of File:readahead. Usage: benchread.py [parts] [ms]
+
+class SlowDHT(dfs.DHT.MemoryDHT):
+	""" A MemoryDHT that waits some time in each request """
+	latency = 0.01
+	def get_many(self, ids):
+		time.sleep(self.latency)
+		return dfs.DHT.MemoryDHT.get_many(self, ids)
+
+parts = 100
+if len(sys.argv) > 1: parts = int(sys.argv[1])
+if len(sys.argv) > 2: SlowDHT.latency = int(sys.argv[2]) / 1000.0
+
+dfs.default_config = Config().set('Main:UID', 'bench').set('Main:nick', 'bench')
+dfs.dht = SlowDHT()
+
+block = dfs.dht.BLOCK_SIZE
+f = File(uri_from_string('dfs://bench/benchread'), 'w')
+f.write(os.urandom(parts * block))
+f.close()
+
+for ahead in (0, 1, 2, 4, 8, 16):
+	dfs.default_config.set('File:readahead', ahead)
+	f = File(uri_from_string('dfs://bench/benchread'), 'r')
+	t = time.time()
+	for d in f.chunks(): pass
+	t = time.time() - t
+	f.close()
+	print 'readahead=%-2d %6.2f s %8.1f KB/s' % (ahead, t, parts * block / t / 1024)
+
+# the second read of the file comes from the cache of blocks
+dfs.block_cache = dfs.utils.BlockCache(2 * parts * block)
+dfs.default_config.set('File:readahead', 4)
+for n in (1, 2):
+	f = File(uri_from_string('dfs://bench/benchread'), 'r')
+	t = time.time()
+	for d in f.chunks(): pass
+	t = time.time() - t
+	f.close()
+	print 'cached read %d   %6.2f s %8.1f KB/s' % (n, t, parts * block / t / 1024)
+print 'cache:', dfs.block_cache
@@ -0,0 +1,46 @@
+import sys, os, time, resource
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dfs
+from dfs.filesystem import File, uri_from_string
+from dfs.utils import Config
+
+# Measures the peak memory of a large write. Usage: benchwrite.py [MB]
+# The DHT discards the blocks, so the growth of the peak RSS before close()
+# is the memory used by the write path of File: about MAX_BUFFER plus one
+# block, and the references to the parts written so far (a few hundred
+# bytes each: with blocks of 1 KB, a large part of the growth).
+# close() also builds the metadata of the file
+
+class NullDHT:
+	""" A DHT that does not save anything """
+	BLOCK_SIZE=1024
+	MAX_VALUE_SIZE=16*1024*1024
+	def put(self, id, data, key=None): return 0
+	def get(self, id, key=None): return None
+	def put_many(self, items): return 0
+	def get_many(self, ids): return [None] * len(ids)
+
+def peak_rss():
+	" Peak resident memory of this process, in KB "
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+mb = 100
+if len(sys.argv) > 1: mb = int(sys.argv[1])
+
+dfs.default_config = Config().set('Main:UID', 'bench').set('Main:nick', 'bench')
+dfs.dht = NullDHT()
+
+chunk = os.urandom(1024 * 1024)
+f = File(uri_from_string('dfs://bench/benchwrite'), 'w', save_metadata=False)
+print 'MAX_BUFFER=%d BLOCK_SIZE=%d' % (f.MAX_BUFFER, f.BLOCK_SIZE)
+before = peak_rss()
+t = time.time()
+for i in range(0, mb):
+	f.write(chunk)
+written = peak_rss()
+f.close()
+t = time.time() - t
+print 'Written %d MB in %.2f s (%.2f MB/s), %d parts' % (mb, t, mb / t, len(f.parts))
+print 'Peak RSS growth before close: %d KB' % (written - before)
+print 'Peak RSS growth after close: %d KB' % (peak_rss() - before)
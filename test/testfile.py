@@ -0,0 +1,440 @@
+import sys, os, random, unittest, io, shutil, StringIO
+from base64 import b64encode
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dfs
+dfs.NO_SECURITY = False
+import dfs.DHT, dfs.utils
+import dfs.filesystem
+from dfs.filesystem import File, uri_from_string, KEY_NAMES
+from dfs.utils import Config
+
+# Unit tests of dfs.filesystem.File on a MemoryDHT. Each test runs
+# without security and, if the crypto module is available, with the
+# keys of the file. Usage: testfile.py [-v]
+
+class FailingDHT(dfs.DHT.MemoryDHT):
+	""" A MemoryDHT that cannot save the values of the n-th call to
+	put_many() """
+	def __init__(self, n):
+		dfs.DHT.MemoryDHT.__init__(self)
+		self.n = n
+	def put_many(self, items):
+		self.n -= 1
+		if self.n == 0: return len(items)
+		return dfs.DHT.MemoryDHT.put_many(self, items)
+
+class RepairingDHT(dfs.DHT.MemoryDHT):
+	""" A MemoryDHT that records the identifiers requested, and saves
+	again the good values of the blocks in repair after they are
+	requested """
+	def __init__(self, hashtable):
+		dfs.DHT.MemoryDHT.__init__(self)
+		self.hashtable = hashtable
+		self.requested = []
+		self.repair = {}
+	def get_many(self, ids):
+		values = dfs.DHT.MemoryDHT.get_many(self, ids)
+		for id, key in ids:
+			self.requested.append(id)
+			if id in self.repair: self.hashtable[b64encode(id)] = self.repair.pop(id)
+		return values
+
+class FileTest(unittest.TestCase):
+	""" Tests of File without security """
+	secured = False
+	def setUp(self):
+		if self.secured and not dfs.filesystem.SECURED:
+			self.skipTest('The crypto module is not available')
+		self.SECURED = dfs.filesystem.SECURED
+		dfs.filesystem.SECURED = self.secured
+		dfs.default_config = Config().set('Main:UID', 'test').set('Main:nick', 'test')
+		if self.secured:
+			for k in KEY_NAMES: dfs.default_config.set_key(k, os.urandom(16))
+		dfs.dht = dfs.DHT.MemoryDHT()
+		dfs.block_cache = dfs.metadata_cache = None
+		self.random = random.Random(5)
+	def tearDown(self):
+		dfs.filesystem.SECURED = self.SECURED
+	def data(self, n):
+		""" Returns n random bytes """
+		return ''.join([chr(self.random.randint(0, 255)) for i in range(0, n)])
+	def write(self, data, mode='w', name='dfs://test/file'):
+		""" Writes data in a file, in several calls to write() """
+		f = File(uri_from_string(name), mode)
+		for i in range(0, len(data), 700): f.write(data[i:i + 700])
+		f.close()
+	def check(self, data, name='dfs://test/file'):
+		""" Checks that the file has data, read at once and after seeks """
+		f = File(uri_from_string(name), 'r')
+		self.assertEqual(f.read(), data)
+		for pos in [0, 1, 1023, 1024, 1025, len(data) / 2, len(data) - 1]:
+			if pos > len(data): continue
+			f.seek(pos)
+			self.assertEqual(f.read(1500), data[pos:pos + 1500])
+		f.close()
+
+	def test_append_partial_block(self):
+		data = self.data(1500)
+		self.write(data)
+		tail = self.data(700)
+		self.write(tail, 'a')
+		self.check(data + tail)
+	def test_append_full_block(self):
+		data = self.data(2048)
+		self.write(data)
+		tail = self.data(100)
+		self.write(tail, 'a')
+		self.check(data + tail)
+	def test_append_several_times(self):
+		data = ''
+		for n in [10, 1, 1030, 0, 3000, 7]:
+			tail = self.data(n)
+			self.write(tail, data and 'a' or 'w')
+			data += tail
+			self.check(data)
+
+	def stored(self):
+		""" Returns the bytes saved in the DHT """
+		return sum([len(v) for values in dfs.dht.hashtable.values() for v in values.values()])
+	def test_last_block_not_padded(self):
+		dfs.default_config.set('File:block', 65536)
+		self.write('small')
+		# a block of metadata and a block of 16 bytes
+		self.assertTrue(self.stored() < 2048)
+		self.check('small')
+		data = self.data(70000)
+		self.write(data)
+		self.assertTrue(self.stored() < 2 * 65536)
+		self.check(data)
+		tail = self.data(100)
+		self.write(tail, 'a')
+		self.check(data + tail)
+		data = self.update(data + tail, [(70050, self.data(5000))])
+		self.check(data)
+
+	def tamper(self, i, name='dfs://test/file'):
+		""" Changes a byte of the block of the i-th part of a file.
+		Returns the hd of the block and its good values """
+		f = File(uri_from_string(name), 'r')
+		f._load_parts(i, i)
+		hd = f.parts[i].hd
+		f.close()
+		values = dfs.dht.hashtable[b64encode(hd)]
+		good = dict(values)
+		for k, d in values.items(): values[k] = d[:10] + chr(ord(d[10]) ^ 1) + d[11:]
+		return hd, good
+	def test_corrupt_block(self):
+		data = self.data(5000)
+		self.write(data)
+		hd, good = self.tamper(2)
+		for retries in (2, 0):
+			dfs.default_config.set('File:retries', retries)
+			for pos, size in ((0, -1), (2100, 100)):
+				dfs.dht = RepairingDHT(dfs.dht.hashtable)
+				f = File(uri_from_string('dfs://test/file'), 'r')
+				f.seek(pos)
+				self.assertRaises(IOError, f.read, size)
+				f.close()
+				# the block is requested again after each error
+				self.assertEqual(dfs.dht.requested.count(hd), retries + 1)
+	def test_corrupt_block_requested_again(self):
+		data = self.data(5000)
+		self.write(data)
+		hd, good = self.tamper(2)
+		dfs.dht = RepairingDHT(dfs.dht.hashtable)
+		dfs.dht.repair[hd] = good
+		f = File(uri_from_string('dfs://test/file'), 'r')
+		self.assertEqual(f.read(), data)
+		f.close()
+		self.assertEqual(dfs.dht.requested.count(hd), 2)
+
+	def test_aead_corrupt_block(self):
+		dfs.default_config.set('File:aead', 'true')
+		data = self.data(5000)
+		self.write(data)
+		f = File(uri_from_string('dfs://test/file'), 'r')
+		# only the encrypted blocks are authenticated
+		self.assertEqual('a' in f.parts[2].flags, self.secured)
+		f.close()
+		self.tamper(2)
+		for pos, size in ((0, -1), (2100, 100)):
+			f = File(uri_from_string('dfs://test/file'), 'r')
+			f.seek(pos)
+			self.assertRaises(IOError, f.read, size)
+			f.close()
+	def test_aead_without_key(self):
+		dfs.default_config.set('File:aead', 'true')
+		data = self.data(5000)
+		self.write(data)
+		# the same keys, but no Kf
+		keys = list(KEY_NAMES)
+		keys[1] = 'none'
+		f = File(uri_from_string('dfs://test/file'), 'r', keys=keys)
+		if self.secured:
+			try:
+				f.read()
+				self.fail('Read authenticated blocks without Kf')
+			except IOError, e:
+				self.assertTrue('No key to authenticate' in str(e))
+		else:
+			self.assertEqual(f.read(), data)
+		f.close()
+
+	def update(self, data, changes, name='dfs://test/file'):
+		""" Overwrites a file in mode 'r+' with a list of (pos, data).
+		Returns the new contents of the file """
+		f = File(uri_from_string(name), 'r+')
+		for pos, d in changes:
+			f.seek(pos)
+			f.write(d)
+			data = data[:pos] + d + data[pos + len(d):]
+		f.close()
+		return data
+	def test_overwrite(self):
+		data = self.data(5000)
+		self.write(data)
+		data = self.update(data, [(0, 'A'), (1020, 'across'), (2048, self.data(1024)), (4000, 'B' * 10)])
+		self.check(data)
+	def test_overwrite_after_end(self):
+		data = self.data(1500)
+		self.write(data)
+		data = self.update(data, [(1400, self.data(700))])
+		self.assertEqual(len(data), 2100)
+		self.check(data)
+	def test_overwrite_and_read(self):
+		data = self.data(3000)
+		self.write(data)
+		f = File(uri_from_string('dfs://test/file'), 'r+')
+		f.seek(1000)
+		f.write('XYZ')
+		f.seek(998)
+		self.assertEqual(f.read(7), data[998:1000] + 'XYZ' + data[1003:1005])
+		f.close()
+		self.check(data[:1000] + 'XYZ' + data[1003:])
+	def test_overwrite_streaming(self):
+		data = self.data(200 * 1024)
+		self.write(data)
+		f = File(uri_from_string('dfs://test/file'), 'r+')
+		f.seek(50)
+		f.write('I')
+		f.seek(0)
+		chunks = []
+		for c in f.chunks(1000):
+			chunks.append(c)
+			# only a few parts are in memory
+			self.assertTrue(len(f.ciphertexts) <= 2)
+		f.close()
+		data = data[:50] + 'I' + data[51:]
+		self.assertEqual(''.join(chunks), data)
+		self.check(data)
+	def test_overwrite_then_append(self):
+		data = self.data(2500)
+		self.write(data)
+		data = self.update(data, [(2400, 'C' * 50)])
+		tail = self.data(900)
+		self.write(tail, 'a')
+		self.check(data + tail)
+
+	def lines(self, n):
+		""" Returns n random lines, some of them longer than a block """
+		return ''.join([self.data(self.random.choice([0, 1, 30, 1100, 2500])).replace('\n', '') + '\n'
+			for i in range(0, n)])
+	def splitlines(self, data):
+		""" Splits data in lines that end in '\\n' only """
+		lines = [l + '\n' for l in data.split('\n')]
+		lines[-1] = lines[-1][:-1]
+		if not lines[-1]: lines.pop()
+		return lines
+	def test_readline(self):
+		data = self.lines(30) + 'no end of line'
+		self.write(data)
+		f = File(uri_from_string('dfs://test/file'), 'r')
+		self.assertEqual(list(f), self.splitlines(data))
+		self.assertEqual(f.readline(), '')
+		f.seek(0)
+		first = self.splitlines(data)[0]
+		self.assertEqual(f.readline(5), first[:5])
+		self.assertEqual(f.readline(), first[5:])
+		self.assertEqual(f.tell(), len(first))
+		f.close()
+	def test_readline_overwrite(self):
+		data = self.lines(10)
+		self.write(data)
+		data = self.update(data, [(1000, '\nY\n')])
+		f = File(uri_from_string('dfs://test/file'), 'r+')
+		self.assertEqual(f.readlines(), self.splitlines(data))
+		f.close()
+	def test_readinto(self):
+		data = self.data(5000)
+		self.write(data)
+		f = File(uri_from_string('dfs://test/file'), 'r')
+		b = bytearray(1500)
+		f.seek(1000)
+		self.assertEqual(f.readinto(b), 1500)
+		self.assertEqual(str(b), data[1000:2500])
+		f.seek(4990)
+		self.assertEqual(f.readinto(b), 10)
+		self.assertEqual(str(b[:10]), data[4990:])
+		self.assertEqual(f.readinto(b), 0)
+		f.close()
+	def test_io_wrappers(self):
+		data = self.lines(20)
+		self.write(data)
+		u = uri_from_string('dfs://test/file')
+		f = io.BufferedReader(File(u, 'r'))
+		self.assertEqual(f.read(), data)
+		f.close()
+		self.assertTrue(f.closed)
+		with io.BufferedReader(File(u, 'r'), 100) as f:
+			self.assertEqual(f.readline(), self.splitlines(data)[0])
+			self.assertEqual(f.read(), ''.join(self.splitlines(data)[1:]))
+		t = io.TextIOWrapper(io.BufferedReader(File(u, 'r')), encoding='latin-1', newline='\n')
+		self.assertEqual(t.readlines(), self.splitlines(data.decode('latin-1')))
+		t.close()
+		out = StringIO.StringIO()
+		f = File(u, 'r')
+		shutil.copyfileobj(f, out, 1000)
+		f.close()
+		self.assertEqual(out.getvalue(), data)
+
+	def test_failed_upload(self):
+		for uploads in (0, 2):
+			dfs.default_config.set('File:uploads', uploads)
+			dfs.dht = FailingDHT(1)
+			f = File(uri_from_string('dfs://test/file'), 'w')
+			try:
+				f.write(self.data(9000))
+			except IOError:
+				# only the synchronous uploads fail in write()
+				self.assertEqual(uploads, 0)
+			self.assertRaises(IOError, f.close)
+			self.assertTrue(f.closed)
+			# the file was not saved
+			self.assertRaises(IOError, File, uri_from_string('dfs://test/file'), 'r')
+	def test_failed_overwrite(self):
+		data = self.data(5000)
+		self.write(data)
+		table = dfs.dht.hashtable
+		dfs.dht = FailingDHT(1)
+		dfs.dht.hashtable = table
+		f = File(uri_from_string('dfs://test/file'), 'r+')
+		f.seek(100)
+		self.assertRaises(IOError, f.write, 'X' * 5000)
+		self.assertRaises(IOError, f.close)
+		# the file keeps its old contents
+		self.check(data)
+
+	def deep_index(self):
+		""" Uses small blocks of metadata and nodes of the index, so
+		that small files have an index of several levels """
+		dfs.default_config.set('File:descPerMetapart', 2).set('File:fanout', 2)
+	def levels(self, name='dfs://test/file'):
+		""" Returns the number of levels of the index of a file """
+		f = File(uri_from_string(name), 'r')
+		f.close()
+		return f.metadata.getint('Main:levels')
+	def test_index(self):
+		self.deep_index()
+		data = self.data(20000)
+		self.write(data)
+		self.assertTrue(self.levels() >= 2)
+		self.check(data)
+	def test_index_loads_on_demand(self):
+		self.deep_index()
+		data = self.data(20000)
+		self.write(data)
+		f = File(uri_from_string('dfs://test/file'), 'r')
+		f.seek(15000)
+		self.assertEqual(f.read(100), data[15000:15100])
+		self.assertTrue(len(f.loaded) < len(f.index[0]))
+		f.close()
+	def test_index_overwrite(self):
+		self.deep_index()
+		data = self.data(20000)
+		self.write(data)
+		data = self.update(data, [(3000, 'D' * 2000), (17000, 'E')])
+		self.assertTrue(self.levels() >= 2)
+		self.check(data)
+	def test_index_append(self):
+		self.deep_index()
+		data = self.data(6000)
+		self.write(data)
+		tail = self.data(30000)
+		self.write(tail, 'a')
+		self.assertTrue(self.levels() >= 3)
+		self.check(data + tail)
+
+	def save_legacy(self, chained, name='dfs://test/file', per_block=3):
+		""" Saves the metadata of a file again in the old format of
+		utils.Config, with per_block references in each block. The
+		blocks are chained with Main:n, or their identifiers are
+		derived from Hd with Main:segments. Chained blocks are
+		encrypted in a single CBC chain """
+		f = File(uri_from_string(name), 'r')
+		f._load_parts(0, len(f.parts) - 1)
+		f.close()
+		main = dict([(k, v) for k, v in f.metadata.main.items()
+			if not k in ('segments', 'levels', 'fanout', 'merkle', 'dpm')])
+		nsegments = (len(f.parts) + per_block - 1) / per_block
+		if not chained and nsegments > 1: main['segments'] = '%d'%nsegments
+		uris = [f.uri]
+		for i in range(1, nsegments):
+			if chained:
+				u = uri_from_string(name)
+				u.hd = os.urandom(16)
+				uris.append(u)
+			else:
+				uris.append(f._segment_uri(i))
+		crypter = f._metadata_crypter(f.uri.get_hd())
+		for i in range(0, max(1, nsegments)):
+			cmd = Config()
+			if i == 0:
+				for k, v in main.items(): cmd.set('Main:%s'%k, v)
+			if chained and i < nsegments - 1: cmd.set('Main:n', uris[i + 1].get_static())
+			for j in range(i * per_block, min(len(f.parts), (i + 1) * per_block)):
+				cmd.set('Part:%d'%j, str(f.parts[j]))
+			cmd.set('Main:p', '')
+			cmd.set('Main:p', dfs.utils.random_string(f.META_SIZE - len(cmd.save())))
+			if not chained: crypter = f._metadata_crypter(uris[i].get_hd())
+			m = crypter.encrypt(cmd.save())
+			dfs.dht.put(uris[i].get_hd(), m, uris[i].nick)
+	def binary(self, name='dfs://test/file'):
+		""" Returns True if the metadata of a file is in the binary format """
+		f = File(uri_from_string(name), 'r')
+		f.close()
+		return bool(f.index)
+	def test_legacy(self):
+		for chained in (True, False):
+			data = self.data(5000)
+			self.write(data)
+			self.save_legacy(chained)
+			self.assertFalse(self.binary())
+			self.check(data)
+			tail = self.data(1500)
+			self.write(tail, 'a')
+			self.assertTrue(self.binary())
+			self.check(data + tail)
+	def test_legacy_overwrite(self):
+		for chained in (True, False):
+			data = self.data(5000)
+			self.write(data)
+			self.save_legacy(chained)
+			data = self.update(data, [(10, 'F' * 1500), (4990, 'G' * 20)])
+			self.assertTrue(self.binary())
+			self.check(data)
+	def test_legacy_index(self):
+		self.deep_index()
+		data = self.data(20000)
+		self.write(data)
+		self.save_legacy(False)
+		data = self.update(data, [(12000, 'H')])
+		self.assertTrue(self.levels() >= 2)
+		self.check(data)
+
+class SecuredFileTest(FileTest):
+	""" Tests of File with the keys of the file """
+	secured = True
+
+if __name__ == '__main__':
+	unittest.main()
@@ -116,18 +116,21 @@ class WebDFS:
 		try:
 			config = cherrypy.session.get('config')
 			f = dfs.filesystem.File(dfs.filesystem.uri_from_string(uri), 'r', config=config)
-			data = f.read()
-			f.close()
 		except:
 			return self.listdir(msg_error='Not found')
 		
 		response = cherrypy.response
 		response.headers['Content-Type'] = 'application/x-download'
 		response.headers["Content-Disposition"] = 'attachment'		
-		response.headers['Content-Length'] = len(data)
-		response.body = data
-		return response.body
+		response.headers['Content-Length'] = f.filelength
+		# send the file while it is read from the DHT
+		def stream():
+			for data in f.chunks():
+				yield data
+			f.close()
+		return stream()
 	get.exposed = True
+	get._cp_config = {'response.stream': True}
 	
 	def put(self, file=None):
 		""" Uploads a file """
@@ -192,6 +195,12 @@ if __name__ == '__main__':
 	ringconfig.load(open('ringserver.conf', 'r'))
 	#dfs.dht = dfs.DHT.NetClientDHT(ringconfig.get('Ring:server'))
 	dfs.dht = dfs.DHT.LocalDHT()
+	# The blocks of popular files are requested to the DHT only once
+	dfs.block_cache = dfs.utils.BlockCache(ringconfig.getint('Cache:size', 16 * 1024 * 1024),
+		ringconfig.getbool('Cache:plaintext', False))
+	# Directories are opened again in each request
+	dfs.metadata_cache = dfs.utils.BlockCache(ringconfig.getint('Cache:metadata', 1024 * 1024),
+		ttl=ringconfig.getint('Cache:ttl', 30))
 	
 	# Config: read from webserver.conf and add the static directory for statics
 	thisdir = os.path.dirname(os.path.abspath(__file__))